@@ -0,0 +1,39 @@
+"""Micro-benchmark of per-call request validation
+
+Run with ``python benchmarks/validation.py`` from the repository root,
+on this revision and on its parent, to compare the cost of the Geocoder,
+Directions and Maps validators.
+"""
+
+import timeit
+
+import mapbox
+
+NUMBER = 20000
+
+geocoder = mapbox.Geocoder(access_token='pk.test')
+maps = mapbox.Maps(access_token='pk.test')
+directions = mapbox.Directions(access_token='pk.test')
+
+CASES = [
+    ('Geocoder._validate_country_codes (3 codes)',
+     lambda: geocoder._validate_country_codes(('us', 'ca', 'mx'))),
+    ('Geocoder._validate_place_types (2 types)',
+     lambda: geocoder._validate_place_types(('address', 'poi'))),
+    ('Directions._validate_profile',
+     lambda: directions._validate_profile('mapbox/cycling')),
+    ('Directions._validate_annotations (2 annotations)',
+     lambda: directions._validate_annotations(['duration', 'speed'])),
+    ('Maps._validate_label',
+     lambda: maps._validate_label('a')),
+    ('Maps._validate_color',
+     lambda: maps._validate_color('ff0000')),
+    ('Maps._validate_file_format',
+     lambda: maps._validate_file_format('png')),
+]
+
+
+if __name__ == '__main__':
+    for name, func in CASES:
+        seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+        print('{0:<50} {1:8.2f} us'.format(name, seconds / NUMBER * 1e6))
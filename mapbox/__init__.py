@@ -5,7 +5,7 @@ from .services.datasets import Datasets
 from .services.directions import Directions
 from .services.geocoding import (
     Geocoder, InvalidCountryCodeError, InvalidPlaceTypeError)
-from .services.mapmatching import MapMatcher
+from .services.mapmatching import MapMatcher, MapMatcherV5
 from .services.matrix import DirectionsMatrix
 from .services.surface import Surface
 from .services.static import Static
@@ -0,0 +1,276 @@
+"""Helpers for long-running batch jobs
+
+Readers for CSV and NDJSON records, an NDJSON result sink, an
+append-only checkpoint journal, job statistics, a request rate
+limiter, and a bounded concurrent map over an iterable of work items.
+"""
+
+import csv
+import io
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from mapbox.compat import string_type
+
+
+def read_records(src, format=None):
+    """Lazily read records from a CSV or NDJSON source
+
+    Parameters
+    ----------
+    src : str or file object
+        A filename or a file object opened in text mode.
+    format : str, optional
+        Either 'csv' or 'ndjson'. By default the format is inferred
+        from the filename extension and NDJSON is assumed otherwise.
+
+    Yields
+    ------
+    dict
+    """
+    if format is None:
+        name = src if isinstance(src, string_type) else getattr(src, 'name', '')
+        format = 'csv' if str(name).lower().endswith('.csv') else 'ndjson'
+    if format not in ('csv', 'ndjson'):
+        raise ValueError("{0} is not a valid record format".format(format))
+
+    if isinstance(src, string_type):
+        with io.open(src, encoding='utf-8', newline='') as f:
+            for record in read_records(f, format=format):
+                yield record
+        return
+
+    if format == 'csv':
+        for row in csv.DictReader(src):
+            yield row
+    else:
+        for line in src:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class NDJSONSink(object):
+    """Appends JSON records to a file, one per line
+
+    Writes are serialized with a lock and flushed immediately so that
+    the file is always consistent with the checkpoint journal.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = io.open(path, 'a', encoding='utf-8')
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self._file.write(line + u'\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Journal(object):
+    """Append-only journal of completed record keys
+
+    A job that marks each record in the journal after its result has
+    been written can be rerun with the same journal and will skip the
+    records that were already completed. Delivery is at-least-once: a
+    crash between writing a result and marking it may repeat that
+    one record on resume.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = set()
+        if os.path.exists(path):
+            with io.open(path, encoding='utf-8') as f:
+                self._done.update(line.rstrip('\n') for line in f if line.strip())
+        self._file = io.open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, key):
+        return str(key) in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def __iter__(self):
+        return iter(list(self._done))
+
+    def mark(self, key):
+        """Record a key as completed"""
+        key = str(key)
+        with self._lock:
+            if key not in self._done:
+                self._done.add(key)
+                self._file.write(key + u'\n')
+                self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Stats(object):
+    """Thread-safe counters for a batch job
+
+    Attributes
+    ----------
+    succeeded : int
+    failed : int
+    skipped : int
+        Records skipped because they were already completed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    @property
+    def processed(self):
+        """Number of records processed in this run"""
+        return self.succeeded + self.failed
+
+    @property
+    def elapsed(self):
+        """Seconds since the job started"""
+        return time.time() - self.started
+
+    @property
+    def throughput(self):
+        """Records processed per second"""
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def error_rate(self):
+        """Fraction of processed records that failed"""
+        return self.failed / float(self.processed) if self.processed else 0.0
+
+    def __repr__(self):
+        return ("<Stats succeeded={0} failed={1} skipped={2} "
+                "throughput={3:.1f}/s>").format(
+                    self.succeeded, self.failed, self.skipped, self.throughput)
+
+
+class RateLimiter(object):
+    """Limits the rate of requests shared by several threads
+
+    Parameters
+    ----------
+    rate : float
+        Maximum number of requests per second.
+    burst : int, optional
+        Number of requests that may be made at once after an idle
+        period. Defaults to 1.
+    """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate must be greater than zero")
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be made"""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def imap_bounded(func, items, max_workers=4, ordered=False):
+    """Apply a function to items concurrently with bounded memory
+
+    At most ``2 * max_workers`` items are read ahead of the results,
+    so ``items`` may be a lazy iterator over an arbitrarily large
+    source.
+
+    Parameters
+    ----------
+    func : callable
+        Called with a single item.
+    items : iterable
+    max_workers : int
+        Number of worker threads.
+    ordered : bool
+        If True, results are yielded in input order. Otherwise they
+        are yielded as they complete.
+
+    Yields
+    ------
+    tuple
+        (item, result, exception). Exactly one of result and
+        exception is meaningful: exceptions raised by func are
+        returned, not raised.
+    """
+    limit = 2 * max_workers
+    pending = deque()
+
+    def finished(future):
+        exc = future.exception()
+        return (future.item, None if exc else future.result(), exc)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in items:
+            future = executor.submit(func, item)
+            future.item = item
+            pending.append(future)
+            while len(pending) >= limit:
+                if ordered:
+                    yield finished(pending.popleft())
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield finished(future)
+        while pending:
+            if ordered:
+                yield finished(pending.popleft())
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield finished(future)
@@ -0,0 +1,167 @@
+"""Application-level caching of API responses
+
+Mapbox Directions responses are not HTTP-cacheable, so CacheControl
+cannot reuse them. A RouteCache keys responses by profile, quantized
+waypoint coordinates, and normalized request parameters and stores
+them in a pluggable store for a profile-dependent time to live.
+"""
+
+from collections import OrderedDict
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class MemoryStore(object):
+    """A thread-safe in-memory store with expiring entries
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        If given, the least recently used entries are evicted beyond
+        this number.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value stored for key, or None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store a value for ttl seconds, or indefinitely"""
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            if self.max_entries is not None:
+                while len(self._data) > self.max_entries:
+                    self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskStore(object):
+    """A store of expiring text values, one file per key
+
+    Parameters
+    ----------
+    directory : str
+        Directory in which entries are written. It is created if it
+        does not exist.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def get(self, key):
+        """Returns the value stored for key, or None"""
+        path = self._path(key)
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                item = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if item['expires'] is not None and item['expires'] < time.time():
+            self.delete(key)
+            return None
+        return item['value']
+
+    def set(self, key, value, ttl=None):
+        """Store a value for ttl seconds, or indefinitely"""
+        expires = time.time() + ttl if ttl is not None else None
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            json.dump({'expires': expires, 'value': value}, f)
+        os.replace(tmp, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class RouteCache(object):
+    """An opt-in cache of Directions responses
+
+    Parameters
+    ----------
+    store : MemoryStore or DiskStore, optional
+        Where responses are kept. Defaults to a MemoryStore of at most
+        1024 entries.
+    precision : int
+        Number of decimal places to which waypoint coordinates are
+        rounded in cache keys. Waypoints that differ by less than
+        this resolution share cached routes. The default of 5 is
+        about one meter.
+    ttl : float
+        Seconds for which routes of static profiles are kept.
+    traffic_ttl : float
+        Seconds for which routes of traffic-aware profiles are kept.
+    """
+
+    traffic_profiles = frozenset(['mapbox/driving-traffic'])
+
+    def __init__(self, store=None, precision=5, ttl=86400, traffic_ttl=300):
+        self.store = store if store is not None else MemoryStore(1024)
+        self.precision = precision
+        self.ttl = ttl
+        self.traffic_ttl = traffic_ttl
+
+    def key(self, profile, points, params):
+        """Returns the cache key for a request
+
+        Parameters
+        ----------
+        profile : str
+        points : sequence
+            (longitude, latitude) waypoint pairs.
+        params : dict
+            Request query parameters.
+        """
+        coords = [[round(float(lon), self.precision),
+                   round(float(lat), self.precision)] for lon, lat in points]
+        return json.dumps([profile, coords, sorted(params.items())])
+
+    def ttl_for(self, profile):
+        """Returns the time to live for routes of a profile"""
+        if profile in self.traffic_profiles:
+            return self.traffic_ttl
+        return self.ttl
+
+    def get(self, profile, points, params):
+        """Returns a cached response body, or None"""
+        return self.store.get(self.key(profile, points, params))
+
+    def set(self, profile, points, params, content):
+        """Cache a response body"""
+        self.store.set(self.key(profile, points, params), content,
+                       ttl=self.ttl_for(profile))
@@ -1,12 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 from numbers import Number
 
 import polyline
+import requests
 from uritemplate import URITemplate
 
+from mapbox.bulk import NDJSONSink, RateLimiter, Stats, imap_bounded
+from mapbox.cache import MemoryStore
 from mapbox.encoding import encode_waypoints as encode_coordinates
+from mapbox.encoding import read_points
 from mapbox.services.base import Service
 from mapbox.compat import string_type
+from mapbox.utils import haversine
 from mapbox import errors
 
 
@@ -16,14 +22,40 @@ class Directions(Service):
     api_name = 'directions'
     api_version = 'v5'
 
-    valid_profiles = [
+    valid_profiles = frozenset([
         'mapbox/driving',
         'mapbox/driving-traffic',
         'mapbox/walking',
-        'mapbox/cycling']
-    valid_geom_encoding = ['geojson', 'polyline', 'polyline6']
-    valid_geom_overview = ['full', 'simplified', False]
-    valid_annotations = ['duration', 'distance', 'speed']
+        'mapbox/cycling'])
+    valid_geom_encoding = frozenset(['geojson', 'polyline', 'polyline6'])
+    valid_geom_overview = frozenset(['full', 'simplified', False])
+    valid_annotations = frozenset(['duration', 'distance', 'speed'])
+
+    # Backwards compatible with v4 profiles
+    v4_to_v5_profiles = {
+        'mapbox.driving': 'mapbox/driving',
+        'mapbox.cycling': 'mapbox/cycling',
+        'mapbox.walking': 'mapbox/walking'}
+
+    def __init__(self, access_token=None, host=None, cache=None,
+                 route_cache=None):
+        """Constructs a Directions service object
+
+        Parameters
+        ----------
+        access_token : str
+            Mapbox access token string.
+        host : str, optional
+            Mapbox API host (advanced usage only).
+        cache : CacheControl cache instance (Dict or FileCache), optional
+            Optional HTTP caching, not generally needed.
+        route_cache : mapbox.cache.RouteCache, optional
+            Optional cache of routes keyed by profile, rounded waypoint
+            coordinates and request parameters.
+        """
+        super(Directions, self).__init__(
+            access_token=access_token, host=host, cache=cache)
+        self.route_cache = route_cache
 
     @property
     def baseuri(self):
@@ -31,13 +63,8 @@ class Directions(Service):
             self.host, self.api_name, self.api_version)
 
     def _validate_profile(self, profile):
-        # Backwards compatible with v4 profiles
-        v4_to_v5_profiles = {
-            'mapbox.driving': 'mapbox/driving',
-            'mapbox.cycling': 'mapbox/cycling',
-            'mapbox.walking': 'mapbox/walking'}
-        if profile in v4_to_v5_profiles:
-            profile = v4_to_v5_profiles[profile]
+        if profile in self.v4_to_v5_profiles:
+            profile = self.v4_to_v5_profiles[profile]
             warnings.warn('Converting v4 profile to v5, use {} instead'.format(profile),
                           errors.MapboxDeprecationWarning)
         if profile not in self.valid_profiles:
@@ -191,7 +218,9 @@ class Directions(Service):
         requests.Response
             The response object has a geojson() method for access to
             the route(s) as a GeoJSON-like FeatureCollection
-            dictionary.
+            dictionary, and a view() method that returns a
+            DirectionsView, which decodes routes, legs, steps and
+            geometries only when they are accessed.
         """
         # backwards compatible, deprecated
         if 'geometry' in kwargs and geometries is None:
@@ -200,6 +229,8 @@ class Directions(Service):
                           errors.MapboxDeprecationWarning)
 
         annotations = self._validate_annotations(annotations)
+        # features may be a generator, and are read more than once
+        features = list(features)
         coordinates = encode_coordinates(
             features, precision=6, min_limit=2, max_limit=25)
         geometries = self._validate_geom_encoding(geometries)
@@ -240,12 +271,327 @@ class Directions(Service):
             self.baseuri + '/{profile_ns}/{profile_name}/{coordinates}.json').expand(
                 profile_ns=profile_ns, profile_name=profile_name, coordinates=coordinates)
 
-        resp = self.session.get(uri, params=params)
-        self.handle_http_error(resp)
+        resp = None
+        if self.route_cache is not None:
+            points = list(read_points(features))
+            content = self.route_cache.get(profile, points, params)
+            if content is not None:
+                resp = self._cached_response(uri, content)
+
+        if resp is None:
+            resp = self.session.get(uri, params=params)
+            self.handle_http_error(resp)
+            if self.route_cache is not None and resp.status_code == 200:
+                self.route_cache.set(profile, points, params, resp.text)
 
         def geojson():
             return self._geojson(resp.json(), geom_format=geometries)
         resp.geojson = geojson
+
+        views = []
+
+        def view():
+            # parsed once; the view decodes its parts as they are accessed
+            if not views:
+                views.append(DirectionsView(resp.json(), geom_format=geometries))
+            return views[0]
+        resp.view = view
+        return resp
+
+    def directions_chunked(self, features, profile='mapbox/driving',
+                           geometries=None, overview=None, steps=None,
+                           waypoint_snapping=None, annotations=None,
+                           language=None, chunk_size=25, max_workers=4,
+                           seam_tolerance=1.0):
+        """Request directions for any number of waypoints.
+
+        The waypoints are split into chunks of at most chunk_size that
+        overlap by one waypoint: the last waypoint of each chunk is the
+        first of the next. The chunks are requested concurrently and
+        their routes are stitched into a single route.
+
+        Parameters
+        ----------
+        features : iterable
+            A collection of GeoJSON Point features or (longitude,
+            latitude) pairs, one per waypoint.
+        profile, geometries, overview, steps, annotations, language
+            As for directions().
+        waypoint_snapping : list
+            As for directions(): one element per feature.
+        chunk_size : int
+            Number of waypoints per request, from 2 to 25.
+        max_workers : int
+            Maximum number of concurrent requests.
+        seam_tolerance : float
+            Distance in meters between the snapped locations of a
+            shared waypoint in two adjacent chunks above which the
+            seam is reported as a mismatch.
+
+        Returns
+        -------
+        StitchedDirections
+            A Directions response-like mapping with a single route in
+            'routes', the merged 'waypoints', and a 'seams' list of
+            mismatches with 'waypoint' (index of the shared waypoint)
+            and 'distance' (meters) items. Like the responses of
+            directions(), it has geojson() and view() methods.
+        """
+        features = list(features)
+        if not 2 <= chunk_size <= 25:
+            raise errors.InvalidParameterError(
+                "chunk_size must be between 2 and 25")
+        if len(features) < 2:
+            raise errors.InvalidFeatureError(
+                "Not enough features to encode coordinates, need at least 2")
+        if waypoint_snapping is not None and \
+                len(waypoint_snapping) != len(features):
+            raise errors.InvalidParameterError(
+                'Must provide exactly one snapping element for each input feature')
+
+        step = chunk_size - 1
+        starts = list(range(0, len(features) - 1, step))
+
+        def request(start):
+            end = start + chunk_size
+            snapping = None
+            if waypoint_snapping is not None:
+                snapping = waypoint_snapping[start:end]
+            resp = self.directions(
+                features[start:end], profile=profile, alternatives=False,
+                geometries=geometries, overview=overview, steps=steps,
+                waypoint_snapping=snapping, annotations=annotations,
+                language=language)
+            if resp.status_code != 200:
+                resp.raise_for_status()
+            return resp.json()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            chunks = list(executor.map(request, starts))
+
+        return StitchedDirections(
+            self._stitch(chunks, starts, geometries, seam_tolerance),
+            self, geom_format=geometries)
+
+    def directions_batch(self, pairs, sink, profile='mapbox/driving',
+                         geometry=False, max_workers=4, rate_limit=None,
+                         dedupe_size=4096, **kwargs):
+        """Request routes for many origin-destination pairs.
+
+        Pairs are read lazily and routed with at most max_workers
+        requests in flight and, optionally, at most rate_limit requests
+        per second. A pair identical to one in flight or to one of the
+        last dedupe_size successfully routed pairs is not routed again.
+        Invalid
+        pairs and failed requests are reported in the results and do
+        not stop the job.
+
+        Parameters
+        ----------
+        pairs : iterable
+            (origin, destination) pairs of GeoJSON Point features or
+            (longitude, latitude) pairs.
+        sink : callable or str
+            Called with one compact result dict per pair, or the
+            filename of an NDJSON file to which results are appended.
+        profile : str
+            Name of a Mapbox profile such as 'mapbox/driving'.
+        geometry : bool
+            Whether to include the route's encoded polyline geometry.
+        max_workers : int
+            Maximum number of concurrent requests.
+        rate_limit : float, optional
+            Maximum number of requests per second.
+        dedupe_size : int
+            Number of recent routes kept to answer repeated pairs.
+        kwargs
+            Other keyword arguments are passed to directions().
+
+        Returns
+        -------
+        mapbox.bulk.Stats
+
+        Each result dict has the 'index' of the pair in the input and
+        either 'distance' and 'duration' (and 'geometry' if requested)
+        of the first route, or an 'error' message. Results are written
+        in completion order.
+        """
+        profile = self._validate_profile(profile)
+        close = []
+        if isinstance(sink, string_type):
+            sink = NDJSONSink(sink)
+            close.append(sink)
+        limiter = RateLimiter(rate_limit) if rate_limit else None
+        overview = kwargs.pop('overview', None if geometry else False)
+
+        stats = Stats()
+        done = MemoryStore(max_entries=dedupe_size)
+        waiting = {}
+
+        def emit(index, result):
+            result = dict(result, index=index)
+            sink(result)
+            stats.record('error' not in result)
+
+        def unique():
+            for index, pair in enumerate(pairs):
+                try:
+                    pair = list(pair)
+                    key = encode_coordinates(pair, min_limit=2, max_limit=2)
+                except (TypeError, ValueError) as exc:
+                    emit(index, {'error': str(exc)})
+                    continue
+                result = done.get(key)
+                if result is not None:
+                    emit(index, result)
+                elif key in waiting:
+                    waiting[key].append(index)
+                else:
+                    waiting[key] = [index]
+                    yield key, pair
+
+        def route(item):
+            if limiter is not None:
+                limiter.acquire()
+            resp = self.directions(
+                item[1], profile=profile, overview=overview, **kwargs)
+            if resp.status_code != 200:
+                return {'error': resp.text, 'status': resp.status_code}
+            data = resp.json()
+            if not data.get('routes'):
+                return {'error': data.get('code', 'NoRoute')}
+            first = data['routes'][0]
+            result = {'distance': first['distance'],
+                      'duration': first['duration']}
+            if geometry:
+                result['geometry'] = first['geometry']
+            return result
+
+        try:
+            for (key, _), result, exc in imap_bounded(
+                    route, unique(), max_workers=max_workers):
+                if exc is not None:
+                    result = {'error': str(exc)}
+                elif 'error' not in result:
+                    # errors may be transient, so repeats are routed again
+                    done.set(key, result)
+                for index in waiting.pop(key):
+                    emit(index, result)
+        finally:
+            for obj in close:
+                obj.close()
+
+        return stats
+
+    def compare_profiles(self, features, profiles=None, geometry=True,
+                         **kwargs):
+        """Request directions for the same waypoints with several
+        profiles concurrently.
+
+        Parameters
+        ----------
+        features : sequence
+            A collection of GeoJSON features or (longitude, latitude)
+            pairs.
+        profiles : sequence, optional
+            Profiles to compare. Defaults to all valid profiles.
+        geometry : bool
+            Whether to include the geometry of each profile's route.
+        kwargs
+            Other keyword arguments are passed to directions().
+
+        Returns
+        -------
+        list
+            One dict per profile, in the order of profiles, with the
+            'profile' and the 'distance', 'duration' and (optionally)
+            'geometry' of its first route, or an 'error' message.
+        """
+        features = list(features)
+        profiles = [self._validate_profile(p)
+                    for p in (profiles or sorted(self.valid_profiles))]
+        if not geometry:
+            kwargs.setdefault('overview', False)
+
+        def compare(profile):
+            resp = self.directions(features, profile=profile, **kwargs)
+            row = {'profile': profile}
+            if resp.status_code != 200:
+                row['error'] = resp.text
+                return row
+            data = resp.json()
+            if not data.get('routes'):
+                row['error'] = data.get('code', 'NoRoute')
+                return row
+            route = data['routes'][0]
+            row.update(distance=route['distance'], duration=route['duration'])
+            if geometry:
+                row['geometry'] = route.get('geometry')
+            return row
+
+        with ThreadPoolExecutor(max_workers=len(profiles)) as executor:
+            return list(executor.map(compare, profiles))
+
+    def _stitch(self, chunks, starts, geom_format, seam_tolerance):
+        """Join the routes of overlapping waypoint chunks"""
+        precision = 6 if geom_format == 'polyline6' else 5
+        coords = []
+        legs = []
+        waypoints = []
+        seams = []
+        totals = {'distance': 0.0, 'duration': 0.0, 'weight': 0.0}
+
+        for i, data in enumerate(chunks):
+            route = data['routes'][0]
+            geom = route.get('geometry')
+            if geom_format == 'geojson':
+                part = [tuple(c) for c in geom['coordinates']] if geom else []
+            else:
+                part = [(lng, lat) for lat, lng in
+                        polyline.decode(geom, precision)] if geom else []
+
+            chunk_waypoints = data.get('waypoints', [])
+            if i > 0:
+                if waypoints and chunk_waypoints:
+                    distance = haversine(
+                        *(waypoints[-1]['location'] +
+                          chunk_waypoints[0]['location']))
+                    if distance > seam_tolerance:
+                        seams.append(
+                            {'waypoint': starts[i], 'distance': distance})
+                chunk_waypoints = chunk_waypoints[1:]
+                if coords and part and coords[-1] == part[0]:
+                    part = part[1:]
+
+            coords.extend(part)
+            legs.extend(route.get('legs', []))
+            waypoints.extend(chunk_waypoints)
+            for key in totals:
+                totals[key] += route.get(key, 0.0)
+
+        route = dict(totals, legs=legs)
+        if 'weight_name' in chunks[0]['routes'][0]:
+            route['weight_name'] = chunks[0]['routes'][0]['weight_name']
+        if geom_format == 'geojson':
+            route['geometry'] = {
+                'type': 'LineString', 'coordinates': [list(c) for c in coords]}
+        elif coords:
+            route['geometry'] = polyline.encode(
+                [(lat, lng) for lng, lat in coords], precision)
+
+        return {'code': 'Ok', 'routes': [route], 'waypoints': waypoints,
+                'seams': seams}
+
+    @staticmethod
+    def _cached_response(uri, content):
+        """Builds a response object from a cached route"""
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = uri
+        resp.encoding = 'utf-8'
+        resp.headers['Content-Type'] = 'application/json; charset=utf-8'
+        resp._content = content.encode('utf-8')
+        resp.from_route_cache = True
         return resp
 
     def _geojson(self, data, geom_format=None):
@@ -271,3 +617,175 @@ class Directions(Service):
                     'duration': route['duration']}}
             fc['features'].append(feature)
         return fc
+
+
+def _decode_geometry(geom, geom_format):
+    """Returns a GeoJSON LineString for a route or step geometry"""
+    if geom is None or geom_format == 'geojson':
+        return geom
+    precision = 6 if geom_format == 'polyline6' else 5
+    return {
+        'type': 'LineString',
+        'coordinates': [(lng, lat) for lat, lng in
+                        polyline.decode(geom, precision)]}
+
+
+class StitchedDirections(dict):
+    """A stitched route returned by Directions.directions_chunked()"""
+
+    def __init__(self, data, service, geom_format=None):
+        super(StitchedDirections, self).__init__(data)
+        self._service = service
+        self._view = None
+        self.geom_format = geom_format
+
+    def geojson(self):
+        """Returns the route as a GeoJSON FeatureCollection"""
+        return self._service._geojson(self, geom_format=self.geom_format)
+
+    def view(self):
+        """Returns a DirectionsView of the route"""
+        if self._view is None:
+            self._view = DirectionsView(self, geom_format=self.geom_format)
+        return self._view
+
+
+class DirectionsView(object):
+    """A lazy view of a Directions response
+
+    Routes, legs and steps are wrapped only when accessed and their
+    encoded geometries are decoded on first access.
+    """
+
+    __slots__ = ('_data', '_geom_format', '_routes')
+
+    def __init__(self, data, geom_format=None):
+        self._data = data
+        self._geom_format = geom_format
+        self._routes = None
+
+    @property
+    def code(self):
+        return self._data.get('code')
+
+    @property
+    def waypoints(self):
+        return self._data.get('waypoints', [])
+
+    @property
+    def routes(self):
+        if self._routes is None:
+            self._routes = tuple(
+                RouteView(route, self._geom_format)
+                for route in self._data.get('routes', []))
+        return self._routes
+
+
+class RouteView(object):
+    """A lazy view of a route"""
+
+    __slots__ = ('_data', '_geom_format', '_geometry', '_legs')
+
+    def __init__(self, data, geom_format=None):
+        self._data = data
+        self._geom_format = geom_format
+        self._geometry = None
+        self._legs = None
+
+    @property
+    def distance(self):
+        return self._data['distance']
+
+    @property
+    def duration(self):
+        return self._data['duration']
+
+    @property
+    def weight(self):
+        return self._data.get('weight')
+
+    @property
+    def geometry(self):
+        """The route geometry as a GeoJSON LineString"""
+        if self._geometry is None:
+            self._geometry = _decode_geometry(
+                self._data.get('geometry'), self._geom_format)
+        return self._geometry
+
+    @property
+    def legs(self):
+        if self._legs is None:
+            self._legs = tuple(
+                LegView(leg, self._geom_format)
+                for leg in self._data.get('legs', []))
+        return self._legs
+
+
+class LegView(object):
+    """A lazy view of a route leg"""
+
+    __slots__ = ('_data', '_geom_format', '_steps')
+
+    def __init__(self, data, geom_format=None):
+        self._data = data
+        self._geom_format = geom_format
+        self._steps = None
+
+    @property
+    def distance(self):
+        return self._data['distance']
+
+    @property
+    def duration(self):
+        return self._data['duration']
+
+    @property
+    def summary(self):
+        return self._data.get('summary')
+
+    @property
+    def annotation(self):
+        return self._data.get('annotation')
+
+    @property
+    def steps(self):
+        if self._steps is None:
+            self._steps = tuple(
+                StepView(step, self._geom_format)
+                for step in self._data.get('steps', []))
+        return self._steps
+
+
+class StepView(object):
+    """A lazy view of a route step"""
+
+    __slots__ = ('_data', '_geom_format', '_geometry')
+
+    def __init__(self, data, geom_format=None):
+        self._data = data
+        self._geom_format = geom_format
+        self._geometry = None
+
+    @property
+    def distance(self):
+        return self._data['distance']
+
+    @property
+    def duration(self):
+        return self._data['duration']
+
+    @property
+    def name(self):
+        return self._data.get('name')
+
+    @property
+    def maneuver(self):
+        return self._data.get('maneuver')
+
+    @property
+    def geometry(self):
+        """The step geometry as a GeoJSON LineString"""
+        if self._geometry is None:
+            self._geometry = _decode_geometry(
+                self._data.get('geometry'), self._geom_format)
+        return self._geometry
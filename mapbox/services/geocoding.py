@@ -1,11 +1,96 @@
 # mapbox
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
+import re
+import threading
+from types import MappingProxyType
+
 from iso3166 import countries
 from uritemplate import URITemplate
 
+from mapbox.bulk import Journal, NDJSONSink, Stats, imap_bounded, read_records
+from mapbox.compat import string_type
 from mapbox.errors import InvalidCountryCodeError, InvalidPlaceTypeError
 from mapbox.services.base import Service
 
 
+# Validation tables are built once at import rather than on every
+# access of Geocoder.country_codes and Geocoder.place_types.
+_COUNTRY_CODES = frozenset(c.alpha2.lower() for c in countries)
+
+_PLACE_TYPES = MappingProxyType({
+    'address': "A street address with house number. Examples: 1600 Pennsylvania Ave NW, 1051 Market St, Oberbaumstrasse 7.",
+    'country': "Sovereign states and other political entities. Examples: United States, France, China, Russia.",
+    'place': "City, town, village or other municipality relevant to a country's address or postal system. Examples: Cleveland, Saratoga Springs, Berlin, Paris.",
+    'locality': "A smaller area within a place that possesses official status and boundaries. Examples: Oakleigh (Melbourne)",
+    'neighborhood': "A smaller area within a place, often without formal boundaries. Examples: Montparnasse, Downtown, Haight-Ashbury.",
+    'poi': "Places of interest including commercial venues, major landmarks, parks, and other features. Examples: Subway Restaurant, Yosemite National Park, Statue of Liberty.",
+    'poi.landmark': "Places of interest that are particularly notable or long-lived like parks, places of worship and museums. A strict subset of the poi place type. Examples: Yosemite National Park, Statue of Liberty.",
+    'postcode': "Postal code, varies by a country's postal system. Examples: 20009, CR0 3RL.",
+    'district': "Second order administrative division. Only used when necessary. Examples: Tianjin, Beijing",
+    'region': "First order administrative divisions within a country, usually provinces or states. Examples: California, Ontario, Essonne."})
+
+DEFAULT_FIELDS = ('center', 'place_name', 'relevance')
+
+_record_types = {}
+
+
+def _record_type(fields):
+    """Returns a namedtuple class for a sequence of field names"""
+    fields = tuple(fields)
+    if fields not in _record_types:
+        _record_types[fields] = namedtuple(
+            'GeocodeRecord', [re.sub(r'\W', '_', f) for f in fields],
+            rename=True)
+    return _record_types[fields]
+
+
+def _add_records(resp):
+    """Adds a records() method that projects the response once per
+    sequence of fields"""
+    projected = {}
+
+    def records(fields=DEFAULT_FIELDS):
+        fields = tuple(fields)
+        if fields not in projected:
+            projected[fields] = project_features(resp.json(), fields)
+        return list(projected[fields])
+    resp.records = records
+
+
+def _getter(field):
+    keys = field.split('.')
+
+    def get(feature):
+        for key in keys:
+            if not isinstance(feature, dict):
+                return None
+            feature = feature.get(key)
+        return feature
+    return get
+
+
+def project_features(data, fields=DEFAULT_FIELDS):
+    """Project geocoding features onto compact records
+
+    :param data: a geocoding response as returned by response.json().
+    :param fields: names of feature members to extract. Dotted names
+        such as 'properties.accuracy' select nested members.
+
+    Returns a list of namedtuples, one per feature, with one item per
+    field. Characters of field names that are not valid in identifiers,
+    such as dots, are replaced by underscores, and names that are still
+    invalid or repeated are replaced by positional ones like _1. Missing
+    members are None. Only the selected values are retained, so the
+    full feature dicts can be released as soon as the call returns.
+    """
+    record = _record_type(fields)
+    getters = [_getter(f) for f in fields]
+    return [record(*[get(feature) for get in getters])
+            for feature in data.get('features', [])]
+
+
 class Geocoder(Service):
     """Access to the Geocoding API V5"""
 
@@ -45,6 +130,8 @@ class Geocoder(Service):
         collection of places matching the given address.
 
         `response.geojson()` returns the geocoding result as GeoJSON.
+        `response.records(fields)` returns a list of compact records of
+        selected feature fields (see project_features).
         `response.status_code` returns the HTTP API status code.
 
         Place results may be constrained to those of one or more types
@@ -76,6 +163,8 @@ class Geocoder(Service):
             return resp.json()
         resp.geojson = geojson
 
+        _add_records(resp)
+
         return resp
 
     def reverse(self, lon, lat, types=None, limit=None):
@@ -83,6 +172,8 @@ class Geocoder(Service):
         collection of places near the given longitude and latitude.
 
         `response.geojson()` returns the geocoding result as GeoJSON.
+        `response.records(fields)` returns a list of compact records of
+        selected feature fields (see project_features).
         `response.status_code` returns the HTTP API status code.
 
         See: https://www.mapbox.com/api-documentation/search/#reverse-geocoding."""
@@ -110,24 +201,363 @@ class Geocoder(Service):
             return resp.json()
         resp.geojson = geojson
 
+        _add_records(resp)
+
         return resp
 
+    def forward_bulk(self, records, sink, query_field='address',
+                     key_field=None, journal=None, max_workers=4,
+                     fields=None, **kwargs):
+        """Forward geocode a stream of records, writing results as they
+        complete.
+
+        Records are read lazily and geocoded with at most max_workers
+        requests in flight, so the input may be arbitrarily large. When
+        a journal is given, completed records are checkpointed and a
+        rerun with the same journal resumes where the previous run
+        stopped.
+
+        Parameters
+        ----------
+        records : iterable of dict, or str
+            Records to geocode, or the filename of a CSV or NDJSON
+            file of records.
+        sink : callable or str
+            Called with one result dict per record, or the filename of
+            an NDJSON file to which results are appended.
+        query_field : str
+            The record field containing the address to geocode.
+        key_field : str, optional
+            The record field that uniquely identifies a record. By
+            default the ordinal position of the record is used.
+        journal : mapbox.bulk.Journal or str, optional
+            Checkpoint journal, or its filename.
+        max_workers : int
+            Maximum number of concurrent requests.
+        fields : sequence of str, optional
+            If given, results are written as lists of feature field
+            values (see project_features) instead of full GeoJSON.
+        kwargs
+            Other keyword arguments are passed to forward().
+
+        Returns
+        -------
+        mapbox.bulk.Stats
+            Counts of succeeded, failed, and skipped records and the
+            job's throughput and error rate.
+
+        Each result dict has the record's 'key' and 'query', the HTTP
+        'status' and the 'result' GeoJSON, or an 'error' message.
+        """
+        if isinstance(records, string_type):
+            records = read_records(records)
+        close = []
+        if isinstance(sink, string_type):
+            sink = NDJSONSink(sink)
+            close.append(sink)
+        if isinstance(journal, string_type):
+            journal = Journal(journal)
+            close.append(journal)
+
+        stats = Stats()
+
+        def pending():
+            for i, record in enumerate(records):
+                try:
+                    key = record[key_field] if key_field else i
+                    query = record[query_field]
+                except KeyError as exc:
+                    # a malformed record is reported, not fatal
+                    sink({'key': None if key_field else i,
+                          'query': record.get(query_field),
+                          'error': 'Record {0} has no {1} field'.format(
+                              i, exc)})
+                    stats.record(False)
+                    continue
+                if journal is not None and key in journal:
+                    stats.skip()
+                    continue
+                yield key, query
+
+        def geocode(item):
+            return self.forward(item[1], **kwargs)
+
+        try:
+            for (key, query), resp, exc in imap_bounded(
+                    geocode, pending(), max_workers=max_workers):
+                result = {'key': key, 'query': query}
+                if exc is not None:
+                    result['error'] = str(exc)
+                else:
+                    result['status'] = resp.status_code
+                    if resp.status_code == 200:
+                        if fields:
+                            result['result'] = [
+                                list(r) for r in resp.records(fields)]
+                        else:
+                            result['result'] = resp.geojson()
+                    else:
+                        result['error'] = resp.text
+                sink(result)
+                ok = 'error' not in result
+                stats.record(ok)
+                # failed records are left out of the journal so that a
+                # rerun retries them
+                if ok and journal is not None:
+                    journal.mark(key)
+        finally:
+            for obj in close:
+                obj.close()
+
+        return stats
+
+    def forward_fanout(self, address, datasets=None, variants=None,
+                       first_relevance=None, max_workers=None, **kwargs):
+        """Returns a GeoJSON FeatureCollection of places matching the
+        given address, merged from several concurrent queries.
+
+        One forward() query is made for every combination of dataset
+        and parameter variant. Features are deduplicated by id, keeping
+        the one with the highest relevance, and sorted by descending
+        relevance.
+
+        :param address: the address to geocode.
+        :param datasets: names of geocoding datasets, such as
+            'mapbox.places' and 'mapbox.places-permanent'. Defaults to
+            this geocoder's dataset.
+        :param variants: a list of dicts of forward() keyword arguments,
+            such as [{'country': ['us']}, {'country': ['ca']}], each of
+            which is combined with kwargs.
+        :param first_relevance: if given, return as soon as any feature
+            with at least this relevance arrives and cancel the queries
+            that have not finished.
+        :param max_workers: maximum number of concurrent requests.
+        :param kwargs: forward() keyword arguments shared by all queries.
+
+        A query that raises an exception or gets an error response does
+        not stop the others. The returned collection's 'failures' member
+        lists such queries, each with its 'dataset', 'params' and an
+        'error' message, and the 'status' of an error response. If every
+        query fails and no features were found, the last failure is
+        raised.
+        """
+        queries = []
+        for dataset in datasets or [self.name]:
+            geocoder = copy.copy(self)
+            geocoder.name = dataset
+            for variant in variants or [{}]:
+                params = dict(kwargs)
+                params.update(variant)
+                queries.append((geocoder, params))
+
+        merged = {}
+        failures = []
+        executor = ThreadPoolExecutor(max_workers=max_workers or len(queries))
+        futures = {}
+        for geocoder, params in queries:
+            future = executor.submit(geocoder.forward, address, **params)
+            futures[future] = (geocoder.name, params)
+        try:
+            for future in as_completed(futures):
+                dataset, params = futures[future]
+                exc = future.exception()
+                if exc is not None:
+                    failures.append({'dataset': dataset, 'params': params,
+                                     'error': str(exc), 'exception': exc})
+                    continue
+                resp = future.result()
+                if resp.status_code != 200:
+                    failures.append({'dataset': dataset, 'params': params,
+                                     'status': resp.status_code,
+                                     'error': resp.text, 'response': resp})
+                    continue
+                done = False
+                for feature in resp.geojson().get('features', []):
+                    relevance = feature.get('relevance', 0)
+                    fid = feature.get('id')
+                    if fid not in merged or \
+                            relevance > merged[fid].get('relevance', 0):
+                        merged[fid] = feature
+                    if first_relevance is not None and \
+                            relevance >= first_relevance:
+                        done = True
+                if done:
+                    break
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        if not merged and len(failures) == len(queries):
+            last = failures[-1]
+            if 'exception' in last:
+                raise last['exception']
+            last['response'].raise_for_status()
+
+        features = sorted(merged.values(),
+                          key=lambda f: f.get('relevance', 0), reverse=True)
+        for failure in failures:
+            failure.pop('exception', None)
+            failure.pop('response', None)
+        return {'type': 'FeatureCollection', 'features': features,
+                'failures': failures}
+
+    def autocomplete(self, delay=0.15, cache_size=256, **params):
+        """Returns an AutocompleteSession for typeahead search.
+
+        :param delay: debounce delay in seconds.
+        :param cache_size: number of query results kept by the session.
+        :param params: forward() keyword arguments, such as lon, lat,
+            bbox, country, types, limit and languages, applied to every
+            query of the session.
+        """
+        return AutocompleteSession(
+            self, delay=delay, cache_size=cache_size, **params)
+
     @property
     def country_codes(self):
-        """A list of valid country codes"""
-        return [c.alpha2.lower() for c in countries]
+        """A frozenset of valid country codes"""
+        return _COUNTRY_CODES
 
     @property
     def place_types(self):
         """A mapping of place type names to descriptions"""
-        return {
-            'address': "A street address with house number. Examples: 1600 Pennsylvania Ave NW, 1051 Market St, Oberbaumstrasse 7.",
-            'country': "Sovereign states and other political entities. Examples: United States, France, China, Russia.",
-            'place': "City, town, village or other municipality relevant to a country's address or postal system. Examples: Cleveland, Saratoga Springs, Berlin, Paris.",
-            'locality': "A smaller area within a place that possesses official status and boundaries. Examples: Oakleigh (Melbourne)",
-            'neighborhood': "A smaller area within a place, often without formal boundaries. Examples: Montparnasse, Downtown, Haight-Ashbury.",
-            'poi': "Places of interest including commercial venues, major landmarks, parks, and other features. Examples: Subway Restaurant, Yosemite National Park, Statue of Liberty.",
-            'poi.landmark': "Places of interest that are particularly notable or long-lived like parks, places of worship and museums. A strict subset of the poi place type. Examples: Yosemite National Park, Statue of Liberty.",
-            'postcode': "Postal code, varies by a country's postal system. Examples: 20009, CR0 3RL.",
-            'district': "Second order administrative division. Only used when necessary. Examples: Tianjin, Beijing",
-            'region': "First order administrative divisions within a country, usually provinces or states. Examples: California, Ontario, Essonne."}
+        return _PLACE_TYPES
+
+
+class AutocompleteSession(object):
+    """A typeahead search session bound to a Geocoder.
+
+    Keystrokes passed to update() are debounced: a query is only sent
+    once input has been idle for the session's delay. A newer keystroke
+    cancels the pending query of an older one, and the result of a
+    request that is already in flight is dropped when it arrives
+    after a newer query was issued. Results are cached per normalized
+    query text, so backspacing to an earlier prefix does not send a
+    new request.
+
+    Example usage:
+
+        session = Geocoder().autocomplete(lon=-122.4, lat=37.8, limit=5)
+        for text in ('S', 'Sa', 'San', 'San F'):
+            session.update(text, show_suggestions)
+        session.close()
+    """
+
+    def __init__(self, geocoder, delay=0.15, cache_size=256, **params):
+        self.geocoder = geocoder
+        self.delay = delay
+        self.cache_size = cache_size
+        self.params = params
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._timer = None
+        self._future = None
+        self._executor = ThreadPoolExecutor(max_workers=2)
+
+    @staticmethod
+    def _normalize(text):
+        return ' '.join(text.lower().split())
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+    def _store(self, key, result):
+        with self._lock:
+            self._cache[key] = result
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _fetch(self, key):
+        resp = self.geocoder.forward(key, **self.params)
+        if resp.status_code != 200:
+            resp.raise_for_status()
+        result = resp.geojson()
+        self._store(key, result)
+        return result
+
+    def search(self, text):
+        """Returns the GeoJSON result for text, from the cache if
+        possible. Blocks until the result is available."""
+        key = self._normalize(text)
+        result = self._cached(key)
+        if result is None:
+            result = self._fetch(key)
+        return result
+
+    def update(self, text, callback, errback=None):
+        """Handle new input text.
+
+        callback(text, geojson) is called with the result for text
+        unless newer input arrives first. errback(text, exc), if given,
+        is called when the request fails.
+        """
+        key = self._normalize(text)
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        self.cancel(_bump=False)
+
+        if not key:
+            return
+        result = self._cached(key)
+        if result is not None:
+            callback(text, result)
+            return
+
+        def done(future):
+            with self._lock:
+                stale = generation != self._generation
+            if stale or future.cancelled():
+                return
+            exc = future.exception()
+            if exc is None:
+                callback(text, future.result())
+            elif errback is not None:
+                errback(text, exc)
+
+        def submit():
+            with self._lock:
+                if generation != self._generation:
+                    return
+                self._future = self._executor.submit(self._fetch, key)
+                future = self._future
+            future.add_done_callback(done)
+
+        if self.delay:
+            timer = threading.Timer(self.delay, submit)
+            timer.daemon = True
+            with self._lock:
+                self._timer = timer
+            timer.start()
+        else:
+            submit()
+
+    def cancel(self, _bump=True):
+        """Cancel the pending query, if any, and drop the result of an
+        in-flight request."""
+        with self._lock:
+            if _bump:
+                self._generation += 1
+            timer, self._timer = self._timer, None
+            future, self._future = self._future, None
+        if timer is not None:
+            timer.cancel()
+        if future is not None:
+            future.cancel()
+
+    def close(self):
+        """Cancel pending work and release the session's threads."""
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,9 +1,184 @@
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
 import json
+import math
+from numbers import Number
+import threading
+import time
+from urllib.parse import urlencode
 
+from dateutil.parser import parse as parse_datetime
+import requests
 from uritemplate import URITemplate
 
 from mapbox import errors
+from mapbox.bulk import NDJSONSink, RateLimiter, Stats, imap_bounded, read_records
+from mapbox.compat import string_type
+from mapbox.encoding import encode_waypoints, read_points
 from mapbox.services.base import Service
+from mapbox.services.directions import Directions, _decode_geometry
+from mapbox.utils import EARTH_RADIUS, haversine
+
+
+def _seconds(value):
+    """Timestamp in seconds from a number or ISO 8601 string"""
+    if isinstance(value, Number):
+        return float(value)
+    dt = parse_datetime(value)
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def _project(coords):
+    """Project positions to local planar meters"""
+    lat0 = math.radians(sum(c[1] for c in coords) / len(coords))
+    kx = math.radians(1) * EARTH_RADIUS * math.cos(lat0)
+    ky = math.radians(1) * EARTH_RADIUS
+    return [(c[0] * kx, c[1] * ky) for c in coords]
+
+
+def _douglas_peucker(points, tolerance):
+    """Indices of points kept by Douglas-Peucker simplification"""
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        norm = math.hypot(dx, dy)
+        index, dmax = None, tolerance
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if norm:
+                d = abs(dy * x - dx * y + x2 * y1 - y2 * x1) / norm
+            else:
+                d = math.hypot(x - x1, y - y1)
+            if d > dmax:
+                index, dmax = i, d
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [i for i, k in enumerate(keep) if k]
+
+
+def _visvalingam(points, tolerance):
+    """Indices of points kept by Visvalingam-Whyatt simplification
+
+    Points are removed in order of the area of the triangle they form
+    with their neighbors while that area is less than tolerance ** 2.
+    """
+    n = len(points)
+    prev = list(range(-1, n - 1))
+    next_ = list(range(1, n + 1))
+    removed = [False] * n
+
+    def area(i):
+        (x1, y1), (x2, y2), (x3, y3) = \
+            points[prev[i]], points[i], points[next_[i]]
+        return abs((x2 - x1) * (y3 - y1) - (x3 - x1) * (y2 - y1)) / 2.0
+
+    heap = [(area(i), i) for i in range(1, n - 1)]
+    heapq.heapify(heap)
+    current = dict((i, a) for a, i in heap)
+    threshold = tolerance ** 2
+    while heap:
+        a, i = heapq.heappop(heap)
+        if removed[i] or current.get(i) != a:
+            continue
+        if a >= threshold:
+            break
+        removed[i] = True
+        p, q = prev[i], next_[i]
+        next_[p], prev[q] = q, p
+        for j in (p, q):
+            if 0 < j < n - 1:
+                current[j] = area(j)
+                heapq.heappush(heap, (current[j], j))
+    return [i for i in range(n) if not removed[i]]
+
+
+def preprocess_trace(feature, min_distance=None, max_speed=None,
+                     tolerance=None, method='douglas-peucker'):
+    """Remove redundant and erroneous fixes from a GPS trace
+
+    The filters are applied in order:
+
+    1. Points within min_distance meters of the previous kept point
+       (stationary jitter and near-duplicates) are dropped.
+    2. Points that imply a speed above max_speed from the previous
+       kept point (position spikes) are dropped. This requires the
+       feature's coordTimes property.
+    3. The remaining line is simplified with the Douglas-Peucker or
+       Visvalingam-Whyatt algorithm, removing points that deviate
+       from a straight line by less than tolerance meters.
+
+    The first and last points are always kept.
+
+    Parameters
+    ----------
+    feature : dict
+        A GeoJSON Feature with LineString geometry and an optional
+        coordTimes property of ISO 8601 strings or seconds.
+    min_distance : float, optional
+        Meters.
+    max_speed : float, optional
+        Meters per second.
+    tolerance : float, optional
+        Meters.
+    method : str
+        'douglas-peucker' or 'visvalingam'.
+
+    Returns
+    -------
+    tuple
+        The reduced feature, and a list mapping each of its points to
+        the index of the point in the input feature. Matched indices
+        returned by the API can be mapped back with this list.
+    """
+    if method not in ('douglas-peucker', 'visvalingam'):
+        raise errors.InvalidParameterError(
+            "{0} is not a valid simplification method".format(method))
+    coords = feature['geometry']['coordinates']
+    properties = feature.get('properties') or {}
+    times = properties.get('coordTimes')
+    if max_speed is not None and times is None:
+        raise errors.InvalidParameterError(
+            "max_speed requires a coordTimes property")
+
+    kept = list(range(len(coords)))
+    if len(coords) > 2 and (min_distance is not None or max_speed is not None):
+        seconds = [_seconds(t) for t in times] if max_speed is not None else None
+        kept = [0]
+        for i in range(1, len(coords) - 1):
+            j = kept[-1]
+            meters = haversine(coords[j][0], coords[j][1],
+                               coords[i][0], coords[i][1])
+            if min_distance is not None and meters < min_distance:
+                continue
+            if max_speed is not None:
+                elapsed = seconds[i] - seconds[j]
+                if elapsed > 0 and meters / elapsed > max_speed:
+                    continue
+            kept.append(i)
+        kept.append(len(coords) - 1)
+
+    if tolerance and len(kept) > 2:
+        points = _project([coords[i] for i in kept])
+        simplify = (_douglas_peucker if method == 'douglas-peucker'
+                    else _visvalingam)
+        kept = [kept[i] for i in simplify(points, tolerance)]
+
+    props = dict(properties)
+    if times is not None:
+        props['coordTimes'] = [times[i] for i in kept]
+    reduced = dict(feature)
+    reduced['properties'] = props
+    reduced['geometry'] = dict(
+        feature['geometry'], coordinates=[coords[i] for i in kept])
+    return reduced, kept
 
 
 class MapMatcher(Service):
@@ -53,3 +228,636 @@ class MapMatcher(Service):
 
         res.geojson = geojson
         return res
+
+    def match_long(self, feature, gps_precision=None, profile='mapbox.driving',
+                   window=100, overlap=10, max_workers=4):
+        """Match a LineString feature with any number of points.
+
+        The trace is split into windows of at most 100 points that
+        overlap by a number of points. The windows are matched
+        concurrently and stitched together: each window contributes
+        the tracepoints up to the middle of its overlap with the next
+        window, and geometries are joined at the matched location of
+        that middle point.
+
+        Parameters
+        ----------
+        feature : dict
+            A GeoJSON Feature with LineString geometry. Its optional
+            coordTimes property is split along with the coordinates.
+        gps_precision : int, optional
+            As for match().
+        profile : str
+            As for match().
+        window : int
+            Number of points per request, at most 100.
+        overlap : int
+            Number of points shared by adjacent windows.
+        max_workers : int
+            Maximum number of concurrent requests.
+
+        Returns
+        -------
+        dict
+            A GeoJSON FeatureCollection with a single Feature. Its
+            LineString geometry is the stitched match, and its
+            properties contain 'indices' and 'matchedPoints' of the
+            matched tracepoints, with indices into the input trace, and
+            a 'windows' list with the 'start' and 'end' point indices
+            and the 'confidence' of each window's matchings.
+        """
+        try:
+            assert feature['type'] == 'Feature'
+            assert feature['geometry']['type'] == 'LineString'
+        except (TypeError, KeyError, AssertionError):
+            raise errors.InvalidFeatureError(
+                "Feature must have LineString geometry")
+        if not 2 <= window <= 100:
+            raise errors.InvalidParameterError(
+                "window must be between 2 and 100")
+        if not 0 <= overlap < window:
+            raise errors.InvalidParameterError(
+                "overlap must be at least 0 and less than window")
+        profile = self._validate_profile(profile)
+
+        coords = feature['geometry']['coordinates']
+        properties = feature.get('properties') or {}
+        times = properties.get('coordTimes')
+        step = window - overlap
+        starts = [0]
+        while starts[-1] + window < len(coords):
+            starts.append(starts[-1] + step)
+        if len(coords) - starts[-1] < 2 < len(coords):
+            # without overlap, a single point may be left for the last
+            # window; the API rejects it, so share one with the window
+            # before
+            starts[-1] = len(coords) - 2
+
+        def request(start):
+            props = dict(properties)
+            if times is not None:
+                props['coordTimes'] = times[start:start + window]
+            part = {
+                'type': 'Feature',
+                'properties': props,
+                'geometry': {
+                    'type': 'LineString',
+                    'coordinates': coords[start:start + window]}}
+            res = self.match(part, gps_precision=gps_precision,
+                             profile=profile)
+            if res.status_code != 200:
+                res.raise_for_status()
+            return res.json()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(request, starts))
+
+        return self._stitch(results, starts, window, overlap, len(coords))
+
+    def match_batch(self, features, sink, gps_precision=None,
+                    profile='mapbox.driving', max_workers=4, retries=2,
+                    backoff=1.0, rate_limit=None):
+        """Match many traces.
+
+        Traces are read lazily and matched with at most max_workers
+        requests in flight. Requests that fail with a connection
+        error, a 429 or a 5xx status are retried after an exponential
+        backoff. Failures are reported in the results and do not stop
+        the job.
+
+        Parameters
+        ----------
+        features : iterable or str
+            GeoJSON Features with LineString geometry, or the filename
+            of an NDJSON file of such features.
+        sink : callable or str
+            Called with one result dict per trace, or the filename of
+            an NDJSON file to which results are appended.
+        gps_precision : int, optional
+            As for match().
+        profile : str
+            As for match().
+        max_workers : int
+            Maximum number of concurrent requests.
+        retries : int
+            Number of times a failed request is retried.
+        backoff : float
+            Seconds to wait before the first retry. The wait doubles
+            with each retry.
+        rate_limit : float, optional
+            Maximum number of requests per second.
+
+        Returns
+        -------
+        mapbox.bulk.Stats
+
+        Each result dict has the 'index' of the trace in the input,
+        its 'id' if it has one, and either the matched 'features' or
+        an 'error' message. Results are written in input order.
+        """
+        profile = self._validate_profile(profile)
+        close = []
+        if isinstance(features, string_type):
+            features = read_records(features, format='ndjson')
+        if isinstance(sink, string_type):
+            sink = NDJSONSink(sink)
+            close.append(sink)
+        limiter = RateLimiter(rate_limit) if rate_limit else None
+        stats = Stats()
+
+        def request(item):
+            index, feature = item
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(backoff * 2 ** (attempt - 1))
+                if limiter is not None:
+                    limiter.acquire()
+                try:
+                    res = self.match(feature, gps_precision=gps_precision,
+                                     profile=profile)
+                except requests.exceptions.RequestException as exc:
+                    error = {'error': str(exc)}
+                    continue
+                if res.status_code == 200:
+                    return {'features': res.json().get('features', [])}
+                error = {'error': res.text, 'status': res.status_code}
+                if res.status_code != 429 and res.status_code < 500:
+                    break
+            return error
+
+        try:
+            for (index, feature), result, exc in imap_bounded(
+                    request, enumerate(features), max_workers=max_workers,
+                    ordered=True):
+                if exc is not None:
+                    result = {'error': str(exc)}
+                result['index'] = index
+                if isinstance(feature, dict) and 'id' in feature:
+                    result['id'] = feature['id']
+                sink(result)
+                stats.record('error' not in result)
+        finally:
+            for obj in close:
+                obj.close()
+
+        return stats
+
+    @staticmethod
+    def _stitch(results, starts, window, overlap, size):
+        """Join the matchings of overlapping windows"""
+        # the first point owned by each window after the first, halfway
+        # through its overlap with the window before
+        seams = [start + (prev + window - start) // 2
+                 for prev, start in zip(starts, starts[1:])]
+
+        def nearest(line, point):
+            return min(range(len(line)), key=lambda i: (
+                (line[i][0] - point[0]) ** 2 + (line[i][1] - point[1]) ** 2))
+
+        coordinates = []
+        indices = []
+        matched_points = []
+        windows = []
+        for w, (start, data) in enumerate(zip(starts, results)):
+            lo = seams[w - 1] if w > 0 else 0
+            hi = seams[w] if w < len(seams) else size
+
+            line = []
+            points = {}
+            confidence = []
+            for feat in data.get('features', []):
+                props = feat.get('properties', {})
+                line.extend(feat['geometry']['coordinates'])
+                confidence.append(props.get('confidence'))
+                for idx, point in zip(props.get('indices', []),
+                                      props.get('matchedPoints', [])):
+                    points[start + idx] = point
+
+            owned = sorted(i for i in points if lo <= i < hi)
+            indices.extend(owned)
+            matched_points.extend(points[i] for i in owned)
+            windows.append({'start': start,
+                            'end': min(start + window, size),
+                            'confidence': confidence})
+
+            # cut the geometry at the matched seam points
+            first, last = 0, len(line)
+            if line and w > 0:
+                after = [i for i in sorted(points) if i >= lo]
+                if after:
+                    first = nearest(line, points[after[0]])
+            if line and w < len(seams):
+                after = [i for i in sorted(points) if i >= hi]
+                before = [i for i in sorted(points) if i < hi]
+                seam = after[0] if after else (before[-1] if before else None)
+                if seam is not None:
+                    last = nearest(line, points[seam]) + 1
+            part = line[first:last]
+            if coordinates and part and coordinates[-1] == part[0]:
+                part = part[1:]
+            coordinates.extend(part)
+
+        return {
+            'type': 'FeatureCollection',
+            'features': [{
+                'type': 'Feature',
+                'properties': {
+                    'indices': indices,
+                    'matchedPoints': matched_points,
+                    'windows': windows},
+                'geometry': {
+                    'type': 'LineString',
+                    'coordinates': coordinates}}]}
+
+
+class MapMatcherV5(Service):
+    """Access to the Map Matching API V5
+
+    Profiles, annotations, geometry formats and radiuses are validated
+    as for Directions. Requests are made with GET unless the URL would
+    exceed max_url_length, in which case the coordinates and options
+    are sent in a form-encoded POST body.
+    """
+
+    api_name = 'matching'
+    api_version = 'v5'
+
+    max_coordinates = 100
+    max_url_length = 8192
+
+    valid_profiles = Directions.valid_profiles
+    valid_geom_encoding = Directions.valid_geom_encoding
+    valid_geom_overview = Directions.valid_geom_overview
+    valid_annotations = Directions.valid_annotations
+    v4_to_v5_profiles = Directions.v4_to_v5_profiles
+
+    _validate_profile = Directions._validate_profile
+    _validate_annotations = Directions._validate_annotations
+    _validate_geom_encoding = Directions._validate_geom_encoding
+    _validate_geom_overview = Directions._validate_geom_overview
+    _validate_radius = Directions._validate_radius
+
+    def _validate_radiuses(self, radiuses, count):
+        if radiuses is None:
+            return None
+        radiuses = list(radiuses)
+        if len(radiuses) != count:
+            raise errors.InvalidParameterError(
+                "Must provide exactly one radius for each coordinate")
+        return [self._validate_radius(r) for r in radiuses]
+
+    def match(self, features, profile='mapbox/driving', timestamps=None,
+              radiuses=None, annotations=None, geometries='polyline6',
+              overview=None, steps=None, tidy=None, language=None):
+        """Match a trace to the road and path network
+
+        Parameters
+        ----------
+        features : dict or iterable
+            A GeoJSON Feature with LineString geometry, or a
+            collection of Point features or (longitude, latitude)
+            pairs, with 2 to 100 positions in all.
+        profile : str
+            Name of a Mapbox profile such as 'mapbox/driving'.
+        timestamps : iterable, optional
+            One timestamp per position, in seconds or ISO 8601. By
+            default the coordTimes property of a LineString feature
+            is used if present.
+        radiuses : iterable of numbers or 'unlimited', optional
+            One GPS accuracy radius in meters per position.
+        annotations : list, optional
+            Any of 'duration', 'distance' and 'speed'.
+        geometries : str
+            Geometry format of matchings: 'polyline6' (the default,
+            and the most compact), 'polyline' or 'geojson'.
+        overview : str or False, optional
+            'full', 'simplified', or False.
+        steps : bool, optional
+            Whether to return turn-by-turn steps.
+        tidy : bool, optional
+            Whether to remove clusters and re-sample the trace.
+        language : str, optional
+            Language of step instructions.
+
+        Returns
+        -------
+        requests.Response
+            The response object has a geojson() method that returns
+            the matchings as a GeoJSON FeatureCollection.
+        """
+        if isinstance(features, dict):
+            if timestamps is None:
+                timestamps = (features.get('properties') or {}).get('coordTimes')
+            features = [features]
+        points = list(read_points(features))
+        coordinates = encode_waypoints(
+            points, precision=6, min_limit=2, max_limit=self.max_coordinates)
+
+        profile = self._validate_profile(profile)
+        annotations = self._validate_annotations(annotations)
+        geometries = self._validate_geom_encoding(geometries)
+        overview = self._validate_geom_overview(overview)
+        radiuses = self._validate_radiuses(radiuses, len(points))
+
+        params = {}
+        if timestamps is not None:
+            timestamps = list(timestamps)
+            if len(timestamps) != len(points):
+                raise errors.InvalidParameterError(
+                    "Must provide exactly one timestamp for each coordinate")
+            params['timestamps'] = ';'.join(
+                str(int(_seconds(t))) for t in timestamps)
+        if radiuses is not None:
+            params['radiuses'] = ';'.join(str(r) for r in radiuses)
+        if annotations:
+            params['annotations'] = ','.join(annotations)
+        if geometries is not None:
+            params['geometries'] = geometries
+        if overview is not None:
+            params['overview'] = 'false' if overview is False else overview
+        if steps is not None:
+            params['steps'] = 'true' if steps else 'false'
+        if tidy is not None:
+            params['tidy'] = 'true' if tidy else 'false'
+        if language is not None:
+            params['language'] = language
+
+        profile_ns, profile_name = profile.split('/')
+        uri = URITemplate(
+            self.baseuri + '/{profile_ns}/{profile_name}/{coordinates}.json'
+        ).expand(profile_ns=profile_ns, profile_name=profile_name,
+                 coordinates=coordinates)
+
+        # the session adds its own params, such as the access token, to
+        # the query string
+        query = dict((k, v) for k, v in self.session.params.items()
+                     if v is not None)
+        query.update(params)
+        if len(uri) + len(urlencode(query)) + 1 > self.max_url_length:
+            uri = URITemplate(
+                self.baseuri + '/{profile_ns}/{profile_name}').expand(
+                    profile_ns=profile_ns, profile_name=profile_name)
+            data = dict(params, coordinates=coordinates)
+            res = self.session.post(uri, data=data)
+        else:
+            res = self.session.get(uri, params=params)
+        self.handle_http_error(res)
+
+        def geojson():
+            return self._geojson(res.json(), geometries)
+
+        res.geojson = geojson
+        return res
+
+    @staticmethod
+    def _geojson(data, geom_format):
+        features = []
+        for matching in data.get('matchings', []):
+            features.append({
+                'type': 'Feature',
+                'geometry': _decode_geometry(
+                    matching.get('geometry'), geom_format),
+                'properties': {
+                    'confidence': matching.get('confidence'),
+                    'distance': matching.get('distance'),
+                    'duration': matching.get('duration')}})
+        return {'type': 'FeatureCollection', 'features': features}
+
+
+class _VehicleStream(object):
+    """Buffered fixes of one vehicle"""
+
+    __slots__ = ('context', 'pending', 'since', 'offset', 'busy', 'overdue')
+
+    def __init__(self):
+        self.context = []
+        self.pending = []
+        self.since = None
+        self.offset = 0
+        self.busy = False
+        # waited max_latency while it could not be submitted
+        self.overdue = False
+
+
+class StreamingMatcher(object):
+    """Incremental map matching of live GPS feeds from many vehicles
+
+    Fixes pushed for a vehicle are buffered until a window of fixes is
+    full or the oldest buffered fix has waited max_latency seconds
+    (checked by poll()). The window is then matched, together with the
+    last overlap fixes of the previous window as context, on a thread
+    pool shared by all vehicles, and the newly matched segment is
+    passed to callback(vehicle, segment). Segments of a vehicle are
+    emitted in order.
+
+    Each segment is a dict with 'indices' (the position of each matched
+    fix in the vehicle's stream), 'matchedPoints', 'confidence' and a
+    GeoJSON LineString 'geometry' that starts where the previous
+    segment ended.
+
+    Example usage:
+
+        matcher = StreamingMatcher(MapMatcher(), on_segment)
+        for vehicle, lon, lat, when in feed:
+            matcher.push(vehicle, lon, lat, when)
+            matcher.poll()
+        matcher.close()
+
+    Parameters
+    ----------
+    matcher : MapMatcher
+    callback : callable
+        Called as callback(vehicle, segment) from a worker thread.
+    window : int
+        Maximum number of fixes per request, at most 100.
+    overlap : int
+        Number of fixes of the previous window sent as context.
+    max_latency : float
+        Seconds a fix may wait before a partial window is matched.
+    max_workers : int
+        Maximum number of concurrent requests for all vehicles.
+    errback : callable, optional
+        Called as errback(vehicle, exception) when a request fails or
+        a single leftover fix is dropped by flush() or close().
+    kwargs
+        Other keyword arguments, such as profile and gps_precision,
+        are passed to match().
+    """
+
+    def __init__(self, matcher, callback, window=50, overlap=5,
+                 max_latency=30.0, max_workers=8, errback=None, **kwargs):
+        if not 2 <= window <= 100:
+            raise errors.InvalidParameterError(
+                "window must be between 2 and 100")
+        if not 0 <= overlap < window - 1:
+            raise errors.InvalidParameterError(
+                "overlap must be at least 0 and less than window - 1")
+        self.matcher = matcher
+        self.callback = callback
+        self.errback = errback
+        self.window = window
+        self.overlap = overlap
+        self.max_latency = max_latency
+        self.kwargs = kwargs
+        self._streams = {}
+        # (deadline, sequence, vehicle) for the oldest pending fixes
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def push(self, vehicle, lon, lat, timestamp=None):
+        """Add a fix to a vehicle's stream"""
+        with self._lock:
+            stream = self._streams.get(vehicle)
+            if stream is None:
+                stream = self._streams[vehicle] = _VehicleStream()
+            if not stream.pending:
+                self._wait(vehicle, stream, time.time())
+            stream.pending.append((lon, lat, timestamp))
+            if stream.overdue or \
+                    len(stream.context) + len(stream.pending) >= self.window:
+                self._submit(vehicle, stream)
+
+    def poll(self, now=None):
+        """Match partial windows whose oldest fix has waited too long"""
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, _, vehicle = heapq.heappop(self._deadlines)
+                stream = self._streams[vehicle]
+                if stream.since is None or \
+                        stream.since + self.max_latency != deadline:
+                    continue
+                # a stream that cannot be submitted now is submitted by
+                # the next push() or when its request completes
+                stream.overdue = True
+                self._submit(vehicle, stream)
+
+    def _wait(self, vehicle, stream, since):
+        # called with the lock held when the oldest pending fix changes
+        stream.since = since
+        stream.overdue = False
+        if since is not None:
+            heapq.heappush(self._deadlines, (
+                since + self.max_latency, next(self._sequence), vehicle))
+
+    def flush(self):
+        """Match all buffered fixes
+
+        A single fix without context cannot be matched. It is dropped
+        and reported to the errback.
+        """
+        with self._lock:
+            dropped = self._flush()
+        self._report(dropped)
+
+    def close(self):
+        """Match all buffered fixes, wait for the results, and release
+        the thread pool"""
+        dropped = []
+        with self._lock:
+            while True:
+                dropped.extend(self._flush())
+                if not any(s.busy for s in self._streams.values()):
+                    break
+                self._idle.wait()
+        self._executor.shutdown()
+        self._report(dropped)
+
+    def _flush(self):
+        # called with the lock held; returns vehicles of dropped fixes
+        dropped = []
+        for vehicle, stream in self._streams.items():
+            if stream.busy or not stream.pending:
+                continue
+            if len(stream.context) + len(stream.pending) < 2:
+                stream.offset += len(stream.pending)
+                stream.pending = []
+                self._wait(vehicle, stream, None)
+                dropped.append(vehicle)
+            else:
+                self._submit(vehicle, stream)
+        return dropped
+
+    def _report(self, dropped):
+        if self.errback is None:
+            return
+        for vehicle in dropped:
+            self.errback(vehicle, errors.InvalidFeatureError(
+                "A single fix cannot be matched"))
+
+    def _submit(self, vehicle, stream):
+        # called with the lock held
+        if stream.busy or not stream.pending:
+            return
+        if len(stream.context) + len(stream.pending) < 2:
+            return
+        take = self.window - len(stream.context)
+        fixes = stream.context + stream.pending[:take]
+        new = len(fixes) - len(stream.context)
+        base = stream.offset - len(stream.context)
+        stream.pending = stream.pending[take:]
+        self._wait(vehicle, stream, time.time() if stream.pending else None)
+        stream.offset += new
+        stream.busy = True
+        self._executor.submit(
+            self._run, vehicle, stream, fixes, len(fixes) - new, base)
+
+    def _run(self, vehicle, stream, fixes, first_new, base):
+        try:
+            data = self._match(fixes)
+        except Exception as exc:
+            if self.errback is not None:
+                self.errback(vehicle, exc)
+        else:
+            self.callback(vehicle, self._segment(data, first_new, base))
+        finally:
+            with self._lock:
+                stream.context = fixes[-self.overlap:] if self.overlap else []
+                stream.busy = False
+                if stream.overdue or len(stream.context) + len(
+                        stream.pending) >= self.window:
+                    self._submit(vehicle, stream)
+                self._idle.notify_all()
+
+    def _match(self, fixes):
+        feature = {
+            'type': 'Feature',
+            'properties': {},
+            'geometry': {
+                'type': 'LineString',
+                'coordinates': [[lon, lat] for lon, lat, _ in fixes]}}
+        if all(t is not None for _, _, t in fixes):
+            feature['properties']['coordTimes'] = [t for _, _, t in fixes]
+        res = self.matcher.match(feature, **self.kwargs)
+        res.raise_for_status()
+        return res.json()
+
+    @staticmethod
+    def _segment(data, first_new, base):
+        line = []
+        points = {}
+        confidence = []
+        for feat in data.get('features', []):
+            props = feat.get('properties', {})
+            line.extend(feat['geometry']['coordinates'])
+            confidence.append(props.get('confidence'))
+            for idx, point in zip(props.get('indices', []),
+                                  props.get('matchedPoints', [])):
+                points[idx] = point
+
+        new = sorted(i for i in points if i >= first_new)
+        seen = [i for i in points if i < first_new]
+        if seen and line:
+            # continue from the last fix of the previous segment
+            start = points[max(seen)]
+            cut = min(range(len(line)), key=lambda i: (
+                (line[i][0] - start[0]) ** 2 + (line[i][1] - start[1]) ** 2))
+            line = line[cut:]
+        return {
+            'indices': [base + i for i in new],
+            'matchedPoints': [points[i] for i in new],
+            'confidence': confidence,
+            'geometry': {'type': 'LineString', 'coordinates': line}}
@@ -1,7 +1,4 @@
-from re import (
-    compile,
-    match
-)
+from re import compile
 
 from mapbox.errors import (
     ValidationError,
@@ -22,6 +19,21 @@ from dateutil.parser import parse
 
 from uritemplate import URITemplate
 
+
+# Label and color patterns are compiled once at import rather than
+# on every call of Maps._validate_label and Maps._validate_color.
+_LABEL_PATTERNS = (
+    compile("^[a-z]{1}$"),
+    compile("^[0]{1}$|^[1-9]{1,2}$"),
+    compile("^[a-zA-Z ]{1,}$")
+)
+
+_COLOR_PATTERNS = (
+    compile("^[a-f0-9]{3}$"),
+    compile("^[a-f0-9]{6}$")
+)
+
+
 class Maps(Service):
     """Access to Maps API V4
 
@@ -33,13 +45,13 @@ class Maps(Service):
     api_version : str
         The API's version number.
 
-    valid_file_formats : list
+    valid_file_formats : frozenset
         The possible values for file_format.
 
-    valid_feature_formats : list
+    valid_feature_formats : frozenset
         The possible values for feature_format.
 
-    valid_marker_names : list
+    valid_marker_names : frozenset
         The possible values for marker_name.
 
     base_uri : str
@@ -50,7 +62,7 @@ class Maps(Service):
 
     api_version = "v4"
 
-    valid_file_formats = [
+    valid_file_formats = frozenset([
         "grid.json",
         "mvt",
         "png",
@@ -60,18 +72,18 @@ class Maps(Service):
         "png256",
         "jpg70",
         "jpg80",
-        "jpg90" 
-    ]
+        "jpg90"
+    ])
 
-    valid_feature_formats = [
+    valid_feature_formats = frozenset([
         "json",
         "kml"
-    ]
+    ])
 
-    valid_marker_names = [
+    valid_marker_names = frozenset([
         "pin-s",
         "pin-l"
-    ]
+    ])
 
     @property
     def base_uri(self):
@@ -164,30 +176,20 @@ class Maps(Service):
     def _validate_label(self, label):
         """Validates label, raising error if invalid."""
 
-        letter_pattern = compile("^[a-z]{1}$")
-        number_pattern = compile("^[0]{1}$|^[1-9]{1,2}$")
-        icon_pattern = compile("^[a-zA-Z ]{1,}$")
-
-        if not match(letter_pattern, label)\
-            and not match(number_pattern, label)\
-                and not match(icon_pattern, label):
-                    raise InvalidLabelError(
-                        "{} is not a valid label".format(label)
-                    )
+        if not any(pattern.match(label) for pattern in _LABEL_PATTERNS):
+            raise InvalidLabelError(
+                "{} is not a valid label".format(label)
+            )
 
         return label
 
     def _validate_color(self, color):
         """Validates color, raising error if invalid."""
 
-        three_digit_pattern = compile("^[a-f0-9]{3}$")
-        six_digit_pattern = compile("^[a-f0-9]{6}$")
-
-        if not match(three_digit_pattern, color)\
-            and not match(six_digit_pattern, color):
-                raise InvalidColorError(
-                    "{} is not a valid color".format(color)
-                )
+        if not any(pattern.match(color) for pattern in _COLOR_PATTERNS):
+            raise InvalidColorError(
+                "{} is not a valid color".format(color)
+            )
 
         return color
 
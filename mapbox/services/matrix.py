@@ -1,11 +1,195 @@
 """Matrix API V1"""
 
+from collections import OrderedDict, deque
+import hashlib
+import heapq
+import json
+import os
 import re
+import time
 import warnings
 
-from mapbox.encoding import encode_waypoints
-from mapbox.errors import InvalidProfileError, MapboxDeprecationWarning
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from mapbox.bulk import Journal, RateLimiter, imap_bounded
+from mapbox.encoding import encode_waypoints, read_points
+from mapbox.errors import (
+    InvalidParameterError, InvalidProfileError, MapboxDeprecationWarning)
 from mapbox.services.base import Service
+from mapbox.utils import EARTH_RADIUS, haversine
+
+
+def plan_pairs(pairs, limit=25):
+    """Pack origin-destination pairs into few matrix requests
+
+    Each request is a (sources, destinations) pair of lists of
+    coordinate indices whose union has at most limit members. Every
+    given pair is a cell of at least one request's sources by
+    destinations matrix. Sources with many destinations in common are
+    packed into the same request by a greedy heuristic.
+
+    Parameters
+    ----------
+    pairs : iterable
+        (source index, destination index) pairs.
+    limit : int
+        Maximum number of coordinates per request.
+
+    Returns
+    -------
+    list
+        (sources, destinations) tuples of sorted index lists.
+    """
+    if limit < 2:
+        raise InvalidParameterError("limit must be at least 2")
+
+    by_source = {}
+    for src, dst in pairs:
+        by_source.setdefault(src, set()).add(dst)
+
+    # split sources with too many destinations into units that fit
+    units = []
+    for src, dsts in by_source.items():
+        dsts = sorted(dsts)
+        size = limit - 1 if src not in dsts else limit
+        if len(dsts) <= size:
+            units.append((src, frozenset(dsts)))
+        else:
+            others = [d for d in dsts if d != src]
+            for i in range(0, len(others), limit - 1):
+                units.append((src, frozenset(others[i:i + limit - 1])))
+            if src in dsts:
+                units[-1] = (src, units[-1][1] | {src})
+    units.sort(key=lambda unit: (-len(unit[1]), unit[0]))
+
+    # coordinates of each unit, the units using each coordinate, and
+    # the units of each size, all in order of preference
+    unit_coords = [dsts | {src} for src, dsts in units]
+    index = {}
+    by_size = {}
+    for i, coords in enumerate(unit_coords):
+        for c in coords:
+            index.setdefault(c, []).append(i)
+        by_size.setdefault(len(coords), deque()).append(i)
+    pending = deque(range(len(units)))
+    alive = [True] * len(units)
+
+    plan = []
+    while pending:
+        first = pending.popleft()
+        if not alive[first]:
+            continue
+        alive[first] = False
+        src, dsts = units[first]
+        sources, destinations = {src}, set(dsts)
+        coords = set()
+        # units sharing coordinates with the request, by the number of
+        # coordinates they would add
+        overlap = {}
+        by_cost = {}
+
+        def grow(new):
+            for c in new - coords:
+                coords.add(c)
+                for i in index[c]:
+                    if alive[i]:
+                        overlap[i] = overlap.get(i, 0) + 1
+                        heapq.heappush(by_cost.setdefault(
+                            len(unit_coords[i]) - overlap[i], []), i)
+
+        grow(unit_coords[first])
+        while True:
+            best = None
+            for cost in range(limit - len(coords) + 1):
+                heap = by_cost.get(cost)
+                while heap and (not alive[heap[0]] or len(
+                        unit_coords[heap[0]]) - overlap[heap[0]] != cost):
+                    heapq.heappop(heap)
+                if heap:
+                    best = heap[0]
+                    break
+                # units without shared coordinates add all of theirs
+                bucket = by_size.get(cost)
+                while bucket and not alive[bucket[0]]:
+                    bucket.popleft()
+                if bucket:
+                    best = bucket[0]
+                    break
+            if best is None:
+                break
+            alive[best] = False
+            s, d = units[best]
+            sources.add(s)
+            destinations.update(d)
+            grow(unit_coords[best])
+        plan.append((sorted(sources), sorted(destinations)))
+    return plan
+
+
+def shortlist_nearest(sources, candidates, k, max_cells=1 << 20):
+    """Find the k nearest candidates to each source by great-circle
+    distance
+
+    Distances are computed with vectorized NumPy operations when NumPy
+    is installed and one pair at a time otherwise.
+
+    Parameters
+    ----------
+    sources, candidates : sequence
+        (longitude, latitude) pairs.
+    k : int
+        Number of candidates per source.
+    max_cells : int, optional
+        Sources are processed in chunks of at most this many
+        source-candidate distances, so memory stays bounded however
+        many sources there are.
+
+    Returns
+    -------
+    list
+        For each source, a list of (candidate index, meters) tuples
+        sorted by distance.
+    """
+    k = min(k, len(candidates))
+    if not sources or k <= 0:
+        return [[] for _ in sources]
+
+    if np is None:
+        return [heapq.nsmallest(
+                    k, ((j, haversine(lon, lat, clon, clat))
+                        for j, (clon, clat) in enumerate(candidates)),
+                    key=lambda item: item[1])
+                for lon, lat in sources]
+
+    src = np.radians(np.asarray(sources, dtype=float))
+    dst = np.radians(np.asarray(candidates, dtype=float))
+    dst_lon, dst_lat = dst[:, 0][None, :], dst[:, 1][None, :]
+    dst_cos = np.cos(dst_lat)
+    rows = max(1, max_cells // len(dst))
+    results = []
+    for start in range(0, len(src), rows):
+        chunk = src[start:start + rows]
+        dlon = dst_lon - chunk[:, 0][:, None]
+        dlat = dst_lat - chunk[:, 1][:, None]
+        # compute in place to keep the number of temporaries low
+        a = np.sin(dlat / 2, out=dlat)
+        a **= 2
+        b = np.sin(dlon / 2, out=dlon)
+        b **= 2
+        b *= dst_cos
+        b *= np.cos(chunk[:, 1])[:, None]
+        a += b
+        np.minimum(a, 1.0, out=a)
+        meters = np.arcsin(np.sqrt(a, out=a), out=a)
+        meters *= 2 * EARTH_RADIUS
+        nearest = np.argpartition(meters, k - 1, axis=1)[:, :k]
+        for i, row in enumerate(nearest):
+            row = row[np.argsort(meters[i, row], kind='stable')]
+            results.append([(int(j), float(meters[i, j])) for j in row])
+    return results
 
 
 class DirectionsMatrix(Service):
@@ -19,6 +203,10 @@ class DirectionsMatrix(Service):
         'mapbox/driving-traffic']
     valid_annotations = ['duration', 'distance']
 
+    # Maximum number of coordinates per request
+    max_coordinates = 25
+    profile_max_coordinates = {'mapbox/driving-traffic': 10}
+
     @property
     def baseuri(self):
         return 'https://{0}/{1}/{2}'.format(
@@ -48,7 +236,7 @@ class DirectionsMatrix(Service):
             return None
         for annotation in annotations:
             if annotation not in self.valid_annotations:
-                raise errors.InvalidParameterError(
+                raise InvalidParameterError(
                     "{0} is not a valid annotation".format(annotation))
             else:
                 results.append(annotation)
@@ -136,3 +324,557 @@ class DirectionsMatrix(Service):
         res = self.session.get(uri, params=params)
         self.handle_http_error(res)
         return res
+
+    def matrix_tiled(self, coordinates, profile='mapbox/driving',
+                     sources=None, destinations=None, annotations=None,
+                     block_size=None, max_workers=4, rate_limit=None,
+                     progress=None, result=None, out=None):
+        """Compute a matrix of any size from concurrent tile requests
+
+        Sources and destinations are split into blocks and every
+        (source block, destination block) tile is requested with the
+        matrix() sources and destinations parameters, so that each
+        request stays within the coordinate limit of the profile. The
+        tiles are assembled into dense NumPy arrays.
+
+        NumPy is required: pip install mapbox[numpy].
+
+        Parameters
+        ----------
+        coordinates : sequence
+            A sequence of coordinates, which may be represented as
+            GeoJSON features, GeoJSON geometries, or (longitude,
+            latitude) pairs.
+        profile : str
+            The trip travel mode.
+        sources : list, optional
+            Indices of source coordinates. Default is all coordinates.
+        destinations : list, optional
+            Indices of destination coordinates. Default is all
+            coordinates.
+        annotations : list, optional
+            'duration', 'distance' or both. Default is duration.
+        block_size : int, optional
+            Number of sources (and of destinations) per tile. Defaults
+            to half the profile's coordinate limit.
+        max_workers : int
+            Maximum number of concurrent requests.
+        rate_limit : float, optional
+            Maximum number of requests per second.
+        progress : callable, optional
+            Called as progress(tiles_done, tiles_total) after each tile.
+        result : TiledMatrix, optional
+            The result of an earlier call with the same arguments.
+            Only its missing and failed tiles are requested.
+        out : str, optional
+            A directory in which the arrays are stored as memory-mapped
+            durations.npy and distances.npy files, with a journal of
+            completed tiles. Each tile is written to disk as it
+            completes, so the matrix never needs to fit in memory, and
+            a later call with the same out directory and arguments
+            requests only the tiles that are missing. The arguments
+            are stored in a job.json file, and a call with different
+            coordinates, sources, destinations, profile, annotations
+            or block_size raises ValueError rather than resume.
+            The tile journal is closed when the call returns. The
+            arrays stay memory-mapped; close() the result, or use it
+            as a context manager, to flush them once done.
+
+        Returns
+        -------
+        TiledMatrix
+            With 'durations' and/or 'distances' arrays of shape
+            (len(sources), len(destinations)) in which cells without
+            a route are NaN, and a 'failed' mapping of tiles to error
+            messages.
+        """
+        if np is None:
+            raise ImportError(
+                "matrix_tiled requires numpy: pip install mapbox[numpy]")
+
+        profile = self._validate_profile(profile)
+        annotations = self._validate_annotations(annotations) or ['duration']
+        points = list(read_points(coordinates))
+        sources = list(range(len(points))) if sources is None else list(sources)
+        destinations = (list(range(len(points))) if destinations is None
+                        else list(destinations))
+
+        limit = self.profile_max_coordinates.get(profile, self.max_coordinates)
+        block_size = block_size or limit // 2
+        if not 1 <= block_size <= limit // 2:
+            raise InvalidParameterError(
+                "block_size must be between 1 and {0}".format(limit // 2))
+
+        job = {
+            'profile': profile,
+            'annotations': list(annotations),
+            'block_size': block_size,
+            'sources': [int(i) for i in sources],
+            'destinations': [int(i) for i in destinations],
+            'coordinates': hashlib.sha256(json.dumps(
+                [list(p) for p in points]).encode('utf-8')).hexdigest()}
+
+        if result is None:
+            result = TiledMatrix(
+                (len(sources), len(destinations)), annotations, block_size,
+                out=out, job=job)
+            opened = True
+        elif result.job is not None and result.job != job:
+            raise InvalidParameterError(
+                "result was computed with different arguments")
+        else:
+            opened = result._open_journal()
+
+        tiles = [(row, col)
+                 for row in range(0, len(sources), block_size)
+                 for col in range(0, len(destinations), block_size)]
+        todo = [tile for tile in tiles if tile not in result.done]
+        limiter = RateLimiter(rate_limit) if rate_limit else None
+
+        def request(tile):
+            row, col = tile
+            srcs = sources[row:row + block_size]
+            dsts = destinations[col:col + block_size]
+            if limiter is not None:
+                limiter.acquire()
+            res = self.matrix(
+                [points[i] for i in srcs + dsts], profile=profile,
+                sources=list(range(len(srcs))),
+                destinations=list(range(len(srcs), len(srcs) + len(dsts))),
+                annotations=annotations)
+            if res.status_code != 200:
+                res.raise_for_status()
+            return res.json()
+
+        try:
+            for tile, data, exc in imap_bounded(
+                    request, todo, max_workers=max_workers):
+                if exc is not None:
+                    result.failed[tile] = str(exc)
+                else:
+                    result._fill(tile, data)
+                if progress is not None:
+                    progress(len(result.done), len(tiles))
+        finally:
+            # the journal is only written while tiles are requested
+            if opened:
+                result._close_journal()
+
+        return result
+
+    def matrix_pairs(self, coordinates, pairs, profile='mapbox/driving',
+                     annotations=None, max_workers=4, rate_limit=None):
+        """Compute travel times for a sparse set of origin-destination pairs
+
+        The pairs are packed into as few matrix() requests as the
+        profile's coordinate limit allows (see plan_pairs) and only the
+        requested cells are returned.
+
+        Parameters
+        ----------
+        coordinates : sequence
+            A sequence of coordinates, which may be represented as
+            GeoJSON features, GeoJSON geometries, or (longitude,
+            latitude) pairs.
+        pairs : iterable
+            (source index, destination index) pairs of indices into
+            coordinates.
+        profile : str
+            The trip travel mode.
+        annotations : list, optional
+            'duration', 'distance' or both. Default is duration.
+        max_workers : int
+            Maximum number of concurrent requests.
+        rate_limit : float, optional
+            Maximum number of requests per second.
+
+        Returns
+        -------
+        dict
+            A mapping of each requested (source, destination) pair to
+            a dict with 'duration' and/or 'distance' values (None if
+            no route was found), or with an 'error' message if its
+            request failed.
+        """
+        profile = self._validate_profile(profile)
+        annotations = self._validate_annotations(annotations) or ['duration']
+        points = list(read_points(coordinates))
+        pairs = set((int(s), int(d)) for s, d in pairs)
+        limit = self.profile_max_coordinates.get(profile, self.max_coordinates)
+        limiter = RateLimiter(rate_limit) if rate_limit else None
+
+        def request(group):
+            sources, destinations = group
+            indexes = sorted(set(sources) | set(destinations))
+            position = dict((idx, pos) for pos, idx in enumerate(indexes))
+            if limiter is not None:
+                limiter.acquire()
+            res = self.matrix(
+                [points[i] for i in indexes], profile=profile,
+                sources=[position[i] for i in sources],
+                destinations=[position[i] for i in destinations],
+                annotations=annotations)
+            if res.status_code != 200:
+                res.raise_for_status()
+            return res.json()
+
+        cells = {}
+        for (sources, destinations), data, exc in imap_bounded(
+                request, plan_pairs(pairs, limit), max_workers=max_workers):
+            for i, src in enumerate(sources):
+                for j, dst in enumerate(destinations):
+                    if (src, dst) not in pairs:
+                        continue
+                    # a pair may be covered by several requests
+                    if 'error' not in cells.get((src, dst), {'error': None}):
+                        continue
+                    if exc is not None:
+                        cells[(src, dst)] = {'error': str(exc)}
+                        continue
+                    cells[(src, dst)] = dict(
+                        (annotation, data[annotation + 's'][i][j])
+                        for annotation in annotations)
+        return cells
+
+    def nearest(self, sources, candidates, k=1, shortlist=None,
+                profile='mapbox/driving', annotations=None, max_workers=4,
+                rate_limit=None):
+        """Rank the nearest candidates to each source by travel time
+
+        Candidates are first shortlisted by great-circle distance (see
+        shortlist_nearest) and travel times are requested only for the
+        shortlisted pairs (see matrix_pairs).
+
+        Parameters
+        ----------
+        sources, candidates : sequence
+            Coordinates, which may be represented as GeoJSON features,
+            GeoJSON geometries, or (longitude, latitude) pairs.
+        k : int
+            Number of ranked candidates returned per source.
+        shortlist : int, optional
+            Number of candidates per source for which travel times are
+            requested. Defaults to k. A larger shortlist reduces the
+            chance of missing a candidate that is near in travel time
+            but not in straight-line distance.
+        profile : str
+            The trip travel mode.
+        annotations : list, optional
+            'duration', 'distance' or both. Default is duration.
+        max_workers : int
+            Maximum number of concurrent requests.
+        rate_limit : float, optional
+            Maximum number of requests per second.
+
+        Returns
+        -------
+        list
+            For each source, a list of up to k dicts with the
+            'candidate' index, the great-circle 'meters' and the
+            requested annotations, sorted by duration (or distance).
+            Candidates without a route or whose request failed are
+            ranked last.
+        """
+        annotations = self._validate_annotations(annotations) or ['duration']
+        sources = list(read_points(sources))
+        candidates = list(read_points(candidates))
+        shortlisted = shortlist_nearest(
+            sources, candidates, max(k, shortlist or k))
+
+        offset = len(sources)
+        pairs = [(i, offset + j)
+                 for i, row in enumerate(shortlisted) for j, _ in row]
+        cells = self.matrix_pairs(
+            sources + candidates, pairs, profile=profile,
+            annotations=annotations, max_workers=max_workers,
+            rate_limit=rate_limit)
+
+        rank_by = 'duration' if 'duration' in annotations else 'distance'
+
+        def rank(item):
+            value = item.get(rank_by)
+            return (value is None, value if value is not None else 0,
+                    item['meters'])
+
+        results = []
+        for i, row in enumerate(shortlisted):
+            ranked = []
+            for j, meters in row:
+                item = {'candidate': j, 'meters': meters}
+                item.update(cells.get((i, offset + j), {}))
+                ranked.append(item)
+            results.append(sorted(ranked, key=rank)[:k])
+        return results
+
+
+class IncrementalMatrix(object):
+    """A travel time matrix over a changing set of locations
+
+    Computed cells are cached per (origin, destination) coordinate
+    pair. When locations are added, update() requests only the cells
+    of the new rows and columns, packed into few requests by
+    matrix_pairs(). Cells expire after a time to live, which by
+    default applies only to traffic-aware profiles.
+
+    Example usage:
+
+        matrix = IncrementalMatrix(DirectionsMatrix(), 'mapbox/driving-traffic')
+        matrix.add('depot', (-122.42, 37.78))
+        matrix.add('stop-1', (-122.41, 37.79))
+        matrix.update()
+        matrix.remove('stop-1')
+        matrix.add('stop-2', (-122.40, 37.77))
+        matrix.update()  # only the stop-2 row and column are requested
+        keys, durations = matrix.durations()
+
+    Parameters
+    ----------
+    service : DirectionsMatrix
+    profile : str
+        The trip travel mode.
+    annotations : list, optional
+        'duration', 'distance' or both. Default is duration.
+    ttl : float, optional
+        Seconds after which cells are recomputed. Defaults to 300 for
+        traffic-aware profiles and to no expiry otherwise.
+    precision : int
+        Number of decimal places to which coordinates are rounded in
+        the cell cache.
+    max_workers : int
+        Maximum number of concurrent requests.
+    rate_limit : float, optional
+        Maximum number of requests per second.
+    """
+
+    traffic_profiles = frozenset(['mapbox/driving-traffic'])
+    default_traffic_ttl = 300
+
+    def __init__(self, service, profile='mapbox/driving', annotations=None,
+                 ttl=None, precision=6, max_workers=4, rate_limit=None):
+        self.service = service
+        self.profile = service._validate_profile(profile)
+        self.annotations = (
+            service._validate_annotations(annotations) or ['duration'])
+        if ttl is None and self.profile in self.traffic_profiles:
+            ttl = self.default_traffic_ttl
+        self.ttl = ttl
+        self.precision = precision
+        self.max_workers = max_workers
+        self.rate_limit = rate_limit
+        self._locations = OrderedDict()
+        self._cells = {}
+
+    def _coordinate(self, coordinate):
+        lon, lat = next(read_points([coordinate]))
+        return (round(float(lon), self.precision),
+                round(float(lat), self.precision))
+
+    @property
+    def keys(self):
+        """Location keys in matrix order"""
+        return list(self._locations)
+
+    def add(self, key, coordinate):
+        """Add or move a location"""
+        self._locations[key] = self._coordinate(coordinate)
+
+    def remove(self, key):
+        """Remove a location and forget cells no longer needed"""
+        del self._locations[key]
+        current = set(self._locations.values())
+        for pair in list(self._cells):
+            if pair[0] not in current or pair[1] not in current:
+                del self._cells[pair]
+
+    def _valid(self, pair, now):
+        cell = self._cells.get(pair)
+        return cell is not None and (cell[0] is None or cell[0] > now)
+
+    def missing(self):
+        """Coordinate pairs whose cells are missing or expired"""
+        now = time.time()
+        coords = list(OrderedDict.fromkeys(self._locations.values()))
+        return [(a, b) for a in coords for b in coords
+                if a != b and not self._valid((a, b), now)]
+
+    def update(self):
+        """Request missing and expired cells
+
+        Returns
+        -------
+        dict
+            Error messages of cells that could not be computed, keyed
+            by coordinate pair. They are requested again by the next
+            update().
+        """
+        missing = self.missing()
+        if not missing:
+            return {}
+        coords = sorted(set(c for pair in missing for c in pair))
+        index = dict((c, i) for i, c in enumerate(coords))
+        cells = self.service.matrix_pairs(
+            coords, [(index[a], index[b]) for a, b in missing],
+            profile=self.profile, annotations=self.annotations,
+            max_workers=self.max_workers, rate_limit=self.rate_limit)
+
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        failed = {}
+        for a, b in missing:
+            values = cells.get((index[a], index[b]), {'error': 'missing'})
+            if 'error' in values:
+                failed[(a, b)] = values['error']
+            else:
+                self._cells[(a, b)] = (expires, values)
+        return failed
+
+    def get(self, src, dst, annotation='duration'):
+        """Returns the cached value for a pair of location keys, or
+        None"""
+        a, b = self._locations[src], self._locations[dst]
+        if a == b:
+            return 0.0
+        cell = self._cells.get((a, b))
+        return cell[1].get(annotation) if cell is not None else None
+
+    def _matrix(self, annotation):
+        keys = self.keys
+        return keys, [[self.get(src, dst, annotation) for dst in keys]
+                      for src in keys]
+
+    def durations(self):
+        """Returns (keys, rows) of cached durations in seconds"""
+        return self._matrix('duration')
+
+    def distances(self):
+        """Returns (keys, rows) of cached distances in meters"""
+        return self._matrix('distance')
+
+
+class TiledMatrix(object):
+    """Durations and distances assembled from matrix tiles
+
+    Attributes
+    ----------
+    durations : numpy.ndarray or None
+        Travel times in seconds, NaN where no route was found or the
+        tile has not been computed.
+    distances : numpy.ndarray or None
+        Distances in meters, likewise.
+    done : set
+        (row, column) offsets of completed tiles.
+    failed : dict
+        Error messages of failed tiles, keyed by (row, column) offset.
+    out : str or None
+        Directory of the memory-mapped arrays, if any.
+    job : dict or None
+        Arguments of the job that computes the matrix. Stored in out
+        and compared when the directory is reopened.
+    """
+
+    def __init__(self, shape, annotations, block_size, out=None, job=None):
+        self.shape = tuple(shape)
+        self.block_size = block_size
+        self.out = out
+        self.job = job
+        self.done = set()
+        self.failed = {}
+        self._journal = None
+        if out is not None:
+            if not os.path.isdir(out):
+                os.makedirs(out)
+            self._check_job()
+            self._open_journal()
+            self.done.update(
+                tuple(int(v) for v in key.split(',')) for key in self._journal)
+        self.durations = self._array('duration', annotations)
+        self.distances = self._array('distance', annotations)
+
+    def _check_job(self):
+        """Records the job in out, or checks it against the recorded one"""
+        path = os.path.join(self.out, 'job.json')
+        job = dict(self.job or {}, shape=list(self.shape),
+                   block_size=self.block_size)
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            if stored != job:
+                changed = sorted(k for k in set(stored) | set(job)
+                                 if stored.get(k) != job.get(k))
+                raise ValueError(
+                    "{0} was written by a job with different {1}".format(
+                        self.out, ', '.join(changed)))
+        elif os.listdir(self.out):
+            raise ValueError(
+                "{0} is not empty and has no job.json".format(self.out))
+        else:
+            with open(path, 'w') as f:
+                json.dump(job, f)
+
+    def _array(self, annotation, annotations):
+        if annotation not in annotations:
+            return None
+        if self.out is None:
+            return np.full(self.shape, np.nan)
+
+        path = os.path.join(self.out, annotation + 's.npy')
+        if os.path.exists(path):
+            array = np.lib.format.open_memmap(path, mode='r+')
+            if array.shape != self.shape:
+                raise ValueError(
+                    "{0} has shape {1}, expected {2}".format(
+                        path, array.shape, self.shape))
+        else:
+            array = np.lib.format.open_memmap(
+                path, mode='w+', dtype='float64', shape=self.shape)
+            for row in range(0, self.shape[0], self.block_size):
+                array[row:row + self.block_size] = np.nan
+            array.flush()
+        return array
+
+    @property
+    def complete(self):
+        """True if every tile has been computed"""
+        rows = -(-self.shape[0] // self.block_size)
+        cols = -(-self.shape[1] // self.block_size)
+        return len(self.done) == rows * cols
+
+    def _fill(self, tile, data):
+        row, col = tile
+        for array, key in ((self.durations, 'durations'),
+                           (self.distances, 'distances')):
+            if array is not None:
+                block = np.array(data[key], dtype=float)
+                array[row:row + block.shape[0], col:col + block.shape[1]] = block
+                if self.out is not None:
+                    array.flush()
+        # tiles are journaled only after their cells are on disk
+        if self._journal is not None:
+            self._journal.mark('{0},{1}'.format(row, col))
+        self.done.add(tile)
+        self.failed.pop(tile, None)
+
+    def _open_journal(self):
+        # returns True if the journal was opened by this call
+        if self.out is None or self._journal is not None:
+            return False
+        self._journal = Journal(os.path.join(self.out, 'tiles.journal'))
+        return True
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def close(self):
+        """Flush memory-mapped arrays and close the tile journal"""
+        for array in (self.durations, self.distances):
+            if array is not None and self.out is not None:
+                array.flush()
+        self._close_journal()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
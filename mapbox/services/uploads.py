@@ -1,16 +1,273 @@
 """Mapbox Uploads API
 """
 
+import calendar
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import io
+import json
+from numbers import Number
+import os
 import re
+import tempfile
+import threading
+import time
+import uuid
 import warnings
+import zlib
 
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from boto3.session import Session as boto3_session
+from botocore.exceptions import ClientError
+from dateutil.parser import parse as parse_datetime
+import requests
 from uritemplate import URITemplate
 
+from mapbox.bulk import RateLimiter
+from mapbox.compat import string_type
 from mapbox.errors import ValidationError
 from mapbox.services.base import Service
 
 
+class UploadProgress(object):
+    """Tracks the progress of a staging transfer
+
+    An instance is passed to boto3 as the transfer callback. It sums
+    the bytes reported by the transfer threads and calls a function
+    with itself after each report.
+
+    Attributes
+    ----------
+    transferred : int
+        Bytes transferred so far.
+    total : int or None
+        Size of the file, if it is known.
+    """
+
+    def __init__(self, func, total=None):
+        self.func = func
+        self.total = total
+        self.transferred = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, num_bytes):
+        with self._lock:
+            self.transferred += num_bytes
+            self.func(self)
+
+    @property
+    def elapsed(self):
+        """Seconds since the transfer started"""
+        return time.time() - self.started
+
+    @property
+    def throughput(self):
+        """Bytes transferred per second"""
+        elapsed = self.elapsed
+        return self.transferred / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def fraction(self):
+        """Fraction of the file transferred, or None"""
+        if not self.total:
+            return None
+        return self.transferred / float(self.total)
+
+
+class FeatureStream(io.RawIOBase):
+    """A GeoJSON FeatureCollection serialized on the fly
+
+    A readable binary stream that serializes features as they are
+    read, so that generated features can be staged without writing a
+    temporary file and with memory bounded by the transfer's part
+    size.
+
+    Parameters
+    ----------
+    features : iterable or mapping
+        GeoJSON-like feature mappings, objects implementing the geo
+        interface, or lines of NDJSON text or bytes. Blank lines are
+        skipped. A single Feature or FeatureCollection mapping is also
+        accepted.
+    compress : bool
+        If True, the stream is gzip-compressed.
+    """
+
+    def __init__(self, features, compress=False):
+        features = getattr(features, '__geo_interface__', features)
+        if isinstance(features, Mapping):
+            if features.get('type') == 'FeatureCollection':
+                features = features.get('features') or []
+            elif features.get('type') == 'Feature':
+                features = [features]
+            else:
+                raise ValidationError(
+                    "A mapping must be a GeoJSON Feature or "
+                    "FeatureCollection")
+        self._chunks = self._serialize(features)
+        self._compressor = zlib.compressobj(
+            6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    @staticmethod
+    def _serialize(features):
+        yield b'{"type": "FeatureCollection", "features": ['
+        separator = b''
+        for feature in features:
+            if isinstance(feature, bytes):
+                data = feature.strip()
+            elif isinstance(feature, string_type):
+                data = feature.strip().encode('utf-8')
+            else:
+                feature = getattr(feature, '__geo_interface__', feature)
+                data = json.dumps(feature).encode('utf-8')
+            if data:
+                yield separator + data
+                separator = b','
+        yield b']}'
+
+    def _next_chunk(self):
+        for chunk in self._chunks:
+            if self._compressor is not None:
+                chunk = self._compressor.compress(chunk)
+            if chunk:
+                return chunk
+        if self._compressor is not None:
+            chunk, self._compressor = self._compressor.flush(), None
+            return chunk
+        return b''
+
+    def readinto(self, b):
+        # fill b unless the stream ends: s3transfer takes a short read
+        # of its multipart threshold for the end of the source
+        view = memoryview(b).cast('B')
+        n = 0
+        while n < len(view):
+            if not self._buffer:
+                self._buffer = self._next_chunk()
+                if not self._buffer:
+                    break
+            size = min(len(view) - n, len(self._buffer))
+            view[n:n + size] = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            n += size
+        return n
+
+
+class UploadManifest(object):
+    """A local record of the sources of uploaded tilesets
+
+    The manifest is a JSON file mapping tileset ids to the SHA-256
+    digest of the source of their last completed upload. It is
+    rewritten atomically after each change.
+
+    Parameters
+    ----------
+    path : str
+        Filename of the manifest. It is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with io.open(path, encoding='utf-8') as f:
+                self._entries = json.load(f)
+
+    def digest(self, tileset):
+        """Returns the digest recorded for a tileset, or None"""
+        entry = self._entries.get(tileset)
+        return entry['sha256'] if entry else None
+
+    def record(self, tileset, digest, upload_id=None):
+        """Record the digest of a tileset's source
+
+        Call this when the upload of the tileset is complete, not when
+        it is created, since processing may still fail.
+        """
+        with self._lock:
+            self._entries[tileset] = {
+                'sha256': digest, 'upload': upload_id, 'time': time.time()}
+            self._save()
+
+    def forget(self, tileset):
+        """Remove the record of a tileset"""
+        with self._lock:
+            if self._entries.pop(tileset, None) is not None:
+                self._save()
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def __contains__(self, tileset):
+        return tileset in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _HashingReader(object):
+    """Computes the SHA-256 digest of a stream as it is read"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def file_digest(fileobj, blocksize=1 << 20):
+    """SHA-256 hex digest of the remainder of a binary file object
+
+    The file is read in blocks and its position is restored.
+    """
+    start = fileobj.tell()
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: fileobj.read(blocksize), b''):
+        sha256.update(block)
+    fileobj.seek(start)
+    return sha256.hexdigest()
+
+
+def _open_source(source):
+    """A binary file object for a filename, file object, or features"""
+    if isinstance(source, (string_type, bytes)) or \
+            hasattr(source, '__fspath__'):
+        return open(source, 'rb')
+    if hasattr(source, 'read'):
+        return source
+    return FeatureStream(source)
+
+
+def _seekable(fileobj):
+    try:
+        return fileobj.seekable()
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+
+def _file_size(fileobj):
+    """Size of the remainder of a file object, or None"""
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
 class Uploader(Service):
     """Access to the Upload API V1
 
@@ -34,6 +291,42 @@ class Uploader(Service):
     api_name = 'uploads'
     api_version = 'v1'
 
+    # Seconds for which reused staging credentials are kept if their
+    # response has no expiration, well within the lifetime of the
+    # temporary AWS credentials, and seconds before a known expiration
+    # at which they are renewed.
+    credentials_ttl = 1800
+    credentials_margin = 300
+
+    def __init__(self, access_token=None, host=None, cache=None,
+                 reuse_credentials=False):
+        """Constructs an Uploader service object
+
+        Parameters
+        ----------
+        access_token : str
+            Mapbox access token string.
+        host : str, optional
+            Mapbox API host (advanced usage only).
+        cache : CacheControl cache instance (Dict or FileCache), optional
+            Optional HTTP caching, not generally needed.
+        reuse_credentials : bool, optional
+            If True, staging credentials are requested once and reused
+            until credentials_margin seconds before they expire, or
+            for credentials_ttl seconds if their expiration is not
+            given, with a new object key under the same prefix for each
+            staged file. If S3 denies access to such a key, the file is
+            staged again with fresh credentials and reuse is turned
+            off for the service.
+        """
+        super(Uploader, self).__init__(
+            access_token=access_token, host=host, cache=cache)
+        self.reuse_credentials = reuse_credentials
+        self._lock = threading.Lock()
+        self._creds = None
+        self._creds_expire = 0
+        self._s3 = (None, None)
+
     def _get_credentials(self):
         """Gets temporary S3 credentials to stage user-uploaded files
         """
@@ -50,6 +343,70 @@ class Uploader(Service):
                 429: "Too many requests"})
         return resp
 
+    def _staging_credentials(self):
+        """Returns credentials for staging one file
+
+        Credentials are requested for every file unless the service
+        reuses them, in which case cached credentials are given a new
+        key and url. Returns the credentials and whether they were
+        reused.
+        """
+        with self._lock:
+            if not self.reuse_credentials:
+                creds = None
+            elif self._creds is None or time.time() >= self._creds_expire:
+                self._creds = self._get_credentials().json()
+                self._creds_expire = self._credentials_expiry(self._creds)
+                return dict(self._creds), False
+            else:
+                creds = dict(self._creds)
+        if creds is None:
+            return self._get_credentials().json(), False
+
+        prefix = creds['key'].rsplit('/', 1)[0]
+        key = '{0}/{1}'.format(prefix, uuid.uuid4().hex)
+        if creds['url'].endswith(creds['key']):
+            creds['url'] = creds['url'][:-len(creds['key'])] + key
+        else:
+            creds['url'] = 'https://{0}.s3.amazonaws.com/{1}'.format(
+                creds['bucket'], key)
+        creds['key'] = key
+        return creds, True
+
+    def _credentials_expiry(self, creds):
+        """Time at which cached credentials are renewed"""
+        expiry = time.time() + self.credentials_ttl
+        expiration = creds.get('expiration')
+        if expiration is not None:
+            if not isinstance(expiration, Number):
+                dt = parse_datetime(expiration)
+                expiration = calendar.timegm(dt.utctimetuple())
+            expiry = min(expiry, expiration - self.credentials_margin)
+        return expiry
+
+    def _stop_reusing_credentials(self):
+        with self._lock:
+            self.reuse_credentials = False
+            self._creds = None
+
+    def _s3_client(self, creds):
+        """Returns an S3 client for credentials
+
+        The client of the most recent credentials is kept and shared,
+        boto3 clients being thread-safe.
+        """
+        ident = (creds['accessKeyId'], creds['secretAccessKey'],
+                 creds['sessionToken'])
+        with self._lock:
+            if self._s3[0] != ident:
+                session = boto3_session(
+                    aws_access_key_id=creds['accessKeyId'],
+                    aws_secret_access_key=creds['secretAccessKey'],
+                    aws_session_token=creds['sessionToken'],
+                    region_name='us-east-1')
+                self._s3 = (ident, session.client('s3'))
+            return self._s3[1]
+
     def _validate_tileset(self, tileset):
         """Validate the tileset name and
         ensure that it includes the username
@@ -74,21 +431,44 @@ class Uploader(Service):
                 DeprecationWarning)
         return username or account or self.username
 
-    def stage(self, fileobj, creds=None, callback=None):
+    def stage(self, fileobj, creds=None, callback=None, progress=None,
+              multipart_threshold=None, multipart_chunksize=None,
+              max_concurrency=None, max_bandwidth=None):
         """Stages data in a Mapbox-owned S3 bucket
 
         If creds are not provided, temporary credentials will be
-        generated using the Mapbox API.
+        generated using the Mapbox API, or reused if the service was
+        constructed with reuse_credentials=True. The boto3 session and
+        S3 client are reused for as long as the credentials are.
 
         Parameters
         ----------
-        fileobj: file object or filename
-            A Python file object opened in binary mode or a filename.
+        fileobj: file object, filename, iterable, or mapping
+            A Python file object opened in binary mode, a filename, an
+            iterable of features or NDJSON lines, or a GeoJSON Feature
+            or FeatureCollection mapping. Features are staged as a
+            GeoJSON FeatureCollection through a FeatureStream.
         creds: dict
             AWS credentials allowing uploads to the destination bucket.
         callback: func
             A function that takes a number of bytes processed as its
             sole argument.
+        progress: func
+            A function called with an UploadProgress, which reports
+            the bytes transferred so far and the throughput, after
+            each chunk is transferred.
+        multipart_threshold: int
+            Size in bytes above which the file is uploaded in parts.
+        multipart_chunksize: int
+            Size in bytes of each part.
+        max_concurrency: int
+            Maximum number of parts uploaded at once.
+        max_bandwidth: int
+            Maximum bandwidth in bytes per second.
+
+        Boto3's defaults are used for transfer settings that are not
+        given. Multi-gigabyte files upload faster with larger parts
+        and more concurrency.
 
         Returns
         -------
@@ -96,23 +476,51 @@ class Uploader(Service):
             The URL of the staged data
         """
 
-        if not hasattr(fileobj, 'read'):
-            fileobj = open(fileobj, 'rb')
+        fileobj = _open_source(fileobj)
 
+        reused = False
         if not creds:
-            res = self._get_credentials()
-            creds = res.json()
-
-        session = boto3_session(
-            aws_access_key_id=creds['accessKeyId'],
-            aws_secret_access_key=creds['secretAccessKey'],
-            aws_session_token=creds['sessionToken'],
-            region_name='us-east-1')
-
-        s3 = session.resource('s3')
-        bucket = s3.Bucket(creds['bucket'])
-        key = creds['key']
-        bucket.upload_fileobj(fileobj, key, Callback=callback)
+            creds, reused = self._staging_credentials()
+        start = fileobj.tell() if reused and _seekable(fileobj) else None
+
+        settings = dict(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
+            max_bandwidth=max_bandwidth)
+        settings = dict((k, v) for k, v in settings.items() if v is not None)
+        config = TransferConfig(**settings) if settings else None
+
+        if progress is not None:
+            tracker = UploadProgress(progress, total=_file_size(fileobj))
+            if callback is None:
+                callback = tracker
+            else:
+                bytes_callback = callback
+
+                def callback(num_bytes):
+                    bytes_callback(num_bytes)
+                    tracker(num_bytes)
+
+        s3 = self._s3_client(creds)
+        try:
+            s3.upload_fileobj(fileobj, creds['bucket'], creds['key'],
+                              Callback=callback, Config=config)
+        except (S3UploadFailedError, ClientError) as exc:
+            # reused credentials may be scoped to the key they were
+            # issued for; stage once more with fresh ones
+            if not reused or 'AccessDenied' not in str(exc):
+                raise
+            self._stop_reusing_credentials()
+            if start is None:
+                raise
+            fileobj.seek(start)
+            if progress is not None:
+                tracker.transferred = 0
+            creds = self._get_credentials().json()
+            s3 = self._s3_client(creds)
+            s3.upload_fileobj(fileobj, creds['bucket'], creds['key'],
+                              Callback=callback, Config=config)
 
         return creds['url']
 
@@ -252,7 +660,10 @@ class Uploader(Service):
         self.handle_http_error(resp)
         return resp
 
-    def upload(self, fileobj, tileset, name=None, patch=False, callback=None, bypass=False):
+    def upload(self, fileobj, tileset, name=None, patch=False, callback=None,
+               bypass=False, progress=None, multipart_threshold=None,
+               multipart_chunksize=None, max_concurrency=None,
+               max_bandwidth=None, manifest=None):
         """Upload data and create a Mapbox tileset
 
         Effectively replicates the Studio upload feature. Returns a
@@ -261,8 +672,9 @@ class Uploader(Service):
 
         Parameters
         ----------
-        fileobj: file object or str
-            A filename or a Python file object opened in binary mode.
+        fileobj: file object, str, or iterable
+            A filename, a Python file object opened in binary mode, or
+            an iterable of features, as for stage().
         tileset: str
             A tileset identifier such as '{owner}.my-tileset'.
         name: str
@@ -277,11 +689,201 @@ class Uploader(Service):
         callback: func
             A function that takes a number of bytes processed as its
             sole argument. May be used with a progress bar.
+        progress, multipart_threshold, multipart_chunksize,
+        max_concurrency, max_bandwidth
+            As for stage().
+        manifest: UploadManifest
+            Optional record of the sources of previous uploads. If the
+            SHA-256 digest of the source matches the one recorded for
+            the tileset, nothing is uploaded and None is returned.
+            Otherwise the digest is set as the response's sha256
+            attribute, to be recorded with manifest.record() once
+            status() reports the upload complete. Seekable sources are
+            hashed before staging; other sources are hashed while they
+            are staged, so only the creation of the upload is skipped.
 
         Returns
         -------
-        requests.Response
+        requests.Response or None
         """
         tileset = self._validate_tileset(tileset)
-        url = self.stage(fileobj, callback=callback)
-        return self.create(url, tileset, name=name, patch=patch, bypass=bypass)
+
+        digest = reader = None
+        if manifest is not None:
+            fileobj = _open_source(fileobj)
+            if _seekable(fileobj):
+                digest = file_digest(fileobj)
+                if digest == manifest.digest(tileset):
+                    return None
+            else:
+                fileobj = reader = _HashingReader(fileobj)
+
+        url = self.stage(
+            fileobj, callback=callback, progress=progress,
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency, max_bandwidth=max_bandwidth)
+
+        if reader is not None:
+            digest = reader.sha256.hexdigest()
+            if digest == manifest.digest(tileset):
+                return None
+
+        resp = self.create(url, tileset, name=name, patch=patch, bypass=bypass)
+        resp.sha256 = digest
+        return resp
+
+    def upload_many(self, uploads, max_workers=4, poll_interval=5.0,
+                    max_poll_interval=60.0, backoff=1.5, rate_limit=2.0,
+                    **kwargs):
+        """Upload many files and wait for their tilesets
+
+        Files are staged and their uploads created concurrently. The
+        status of every created upload is then polled until it is
+        complete or has failed. An upload whose progress has not
+        changed since the last poll is polled less often, by a factor
+        of backoff up to max_poll_interval, and status requests of all
+        uploads are limited to rate_limit per second. Wall-clock time
+        is close to that of the slowest upload.
+
+        Parameters
+        ----------
+        uploads : iterable
+            (fileobj, tileset) or (fileobj, tileset, name) tuples,
+            where fileobj is a filename or a file object opened in
+            binary mode.
+        max_workers : int
+            Maximum number of files staged at once.
+        poll_interval : float
+            Seconds between the creation of an upload and its first
+            status request, and between requests while it progresses.
+        max_poll_interval : float
+            Maximum number of seconds between status requests.
+        backoff : float
+            Factor by which the interval grows when an upload's
+            progress has not changed.
+        rate_limit : float
+            Maximum number of status requests per second.
+        kwargs
+            Other keyword arguments, such as patch and
+            max_concurrency, are passed to upload().
+
+        Yields
+        ------
+        dict
+            Events with a 'type' of 'created', 'progress', 'complete',
+            'error' or 'skipped', and the 'tileset' they concern.
+            Skipped tilesets have an unchanged source in the manifest
+            passed to upload(). The digest of a source is recorded in
+            that manifest when its upload is complete, and removed
+            when it fails. Events other than staging errors and
+            skips carry the latest 'upload' dict, and error events
+            carry an 'error' message.
+        """
+        limiter = RateLimiter(rate_limit)
+        polling = {}
+
+        def start(item):
+            fileobj, tileset = item[:2]
+            name = item[2] if len(item) > 2 else None
+            return self.upload(fileobj, tileset, name=name, **kwargs)
+
+        def poll(upload_id, job):
+            # returns an event or None, and whether the upload is done
+            try:
+                resp = self.status(upload_id)
+            except requests.exceptions.RequestException:
+                # a connection error or timeout is retried like a 5xx
+                return None, False
+            event = {'tileset': job['tileset']}
+            if resp.status_code == 429 or resp.status_code >= 500:
+                return None, False
+            if resp.status_code != 200:
+                event.update(type='error', error=resp.text,
+                             status=resp.status_code)
+                return event, True
+            upload = event['upload'] = resp.json()
+            if upload.get('error'):
+                event.update(type='error', error=upload['error'])
+                return event, True
+            if upload.get('complete'):
+                event['type'] = 'complete'
+                return event, True
+            if upload.get('progress') != job['progress']:
+                job['progress'] = upload.get('progress')
+                event['type'] = 'progress'
+                return event, False
+            return None, False
+
+        manifest = kwargs.get('manifest')
+
+        def update_manifest(upload_id, job, event):
+            upload = event.get('upload') or {}
+            key = upload.get('tileset') or self._validate_tileset(
+                job['tileset'])
+            if event['type'] == 'complete' and job['sha256'] is not None:
+                manifest.record(key, job['sha256'], upload_id)
+            elif event['type'] == 'error':
+                manifest.forget(key)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            for item in uploads:
+                pending[executor.submit(start, item)] = item[1]
+
+            while pending or polling:
+                timeout = None
+                if polling:
+                    due = min(job['due'] for job in polling.values())
+                    timeout = max(0, due - time.time())
+                if pending:
+                    done, _ = wait(pending, timeout=timeout,
+                                   return_when=FIRST_COMPLETED)
+                else:
+                    done = ()
+                    time.sleep(timeout)
+
+                for future in done:
+                    tileset = pending.pop(future)
+                    exc = future.exception()
+                    if exc is not None:
+                        yield {'type': 'error', 'tileset': tileset,
+                               'error': str(exc)}
+                        continue
+                    resp = future.result()
+                    if resp is None:
+                        yield {'type': 'skipped', 'tileset': tileset}
+                        continue
+                    if resp.status_code != 201:
+                        yield {'type': 'error', 'tileset': tileset,
+                               'error': resp.text,
+                               'status': resp.status_code}
+                        continue
+                    upload = resp.json()
+                    polling[upload['id']] = {
+                        'tileset': tileset,
+                        'sha256': getattr(resp, 'sha256', None),
+                        'progress': upload.get('progress'),
+                        'interval': poll_interval,
+                        'due': time.time() + poll_interval}
+                    yield {'type': 'created', 'tileset': tileset,
+                           'upload': upload}
+
+                now = time.time()
+                for upload_id, job in list(polling.items()):
+                    if job['due'] > now:
+                        continue
+                    limiter.acquire()
+                    event, finished = poll(upload_id, job)
+                    if finished:
+                        del polling[upload_id]
+                        if manifest is not None:
+                            update_manifest(upload_id, job, event)
+                    elif event is not None:
+                        job['interval'] = poll_interval
+                    else:
+                        job['interval'] = min(
+                            job['interval'] * backoff, max_poll_interval)
+                    job['due'] = time.time() + job['interval']
+                    if event is not None:
+                        yield event
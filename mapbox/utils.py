@@ -1,3 +1,4 @@
+import math
 import sys
 try:
     from collections.abc import Mapping, Sequence
@@ -33,3 +34,16 @@ def normalize_geojson_featurecollection(obj):
                 "Expecting a geojson-like mapping or sequence of them")
 
     return {'type': 'FeatureCollection', 'features': features}
+
+
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """Great-circle distance in meters between two positions"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlam = math.radians(lon2 - lon1)
+    a = (math.sin(dphi / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(dlam / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
@@ -24,12 +24,11 @@ setup(name='mapbox',
                    'Intended Audience :: Developers',
                    'License :: OSI Approved :: MIT License',
                    'Programming Language :: Python',
-                   'Programming Language :: Python :: 2.7',
                    'Programming Language :: Python :: 3',
-                   'Programming Language :: Python :: 3.3',
-                   'Programming Language :: Python :: 3.4',
-                   'Programming Language :: Python :: 3.5',
-                   'Programming Language :: Python :: 3.6'],
+                   'Programming Language :: Python :: 3.6',
+                   'Programming Language :: Python :: 3.7',
+                   'Programming Language :: Python :: 3.8',
+                   'Programming Language :: Python :: 3.9'],
       keywords='',
       author="Sean Gillies",
       author_email='sean@mapbox.com',
@@ -38,6 +37,7 @@ setup(name='mapbox',
       packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
       include_package_data=True,
       zip_safe=False,
+      python_requires='>=3.6',
       install_requires=[
           'boto3>=1.4',
           'cachecontrol',
@@ -47,5 +47,7 @@ setup(name='mapbox',
           'polyline>=1.3.1',
           'uritemplate>=2.0'],
       extras_require={
+          'numpy': ['numpy'],
           'test': [
-              'coveralls', 'pytest>=2.8.3', 'pytest-cov', 'responses', 'tox']})
+              'coveralls', 'numpy', 'pytest>=2.8.3', 'pytest-cov', 'responses',
+              'tox']})
@@ -0,0 +1,92 @@
+import json
+import time
+
+import pytest
+
+from mapbox.bulk import (
+    Journal, NDJSONSink, RateLimiter, Stats, imap_bounded, read_records)
+
+
+def test_read_records_csv(tmpdir):
+    src = tmpdir.join('addresses.csv')
+    src.write('id,address\n1,1600 pennsylvania ave nw\n2,1051 market st\n')
+    records = list(read_records(str(src)))
+    assert records == [
+        {'id': '1', 'address': '1600 pennsylvania ave nw'},
+        {'id': '2', 'address': '1051 market st'}]
+
+
+def test_read_records_ndjson(tmpdir):
+    src = tmpdir.join('addresses.ndjson')
+    src.write('{"address": "a"}\n\n{"address": "b"}\n')
+    assert list(read_records(str(src))) == [{'address': 'a'}, {'address': 'b'}]
+
+
+def test_read_records_invalid_format():
+    with pytest.raises(ValueError):
+        list(read_records('addresses.txt', format='xml'))
+
+
+def test_ndjson_sink(tmpdir):
+    path = str(tmpdir.join('out.ndjson'))
+    with NDJSONSink(path) as sink:
+        sink({'a': 1})
+        sink({'b': 2})
+    with open(path) as f:
+        assert [json.loads(line) for line in f] == [{'a': 1}, {'b': 2}]
+
+
+def test_journal_resume(tmpdir):
+    path = str(tmpdir.join('journal'))
+    with Journal(path) as journal:
+        journal.mark(1)
+        journal.mark('b')
+        journal.mark(1)
+    with Journal(path) as journal:
+        assert 1 in journal
+        assert 'b' in journal
+        assert 2 not in journal
+        assert len(journal) == 2
+
+
+def test_stats():
+    stats = Stats()
+    stats.record(True)
+    stats.record(True)
+    stats.record(False)
+    stats.skip()
+    assert stats.processed == 3
+    assert stats.skipped == 1
+    assert stats.error_rate == pytest.approx(1 / 3.0)
+    assert stats.throughput > 0
+
+
+def test_imap_bounded_ordered():
+    def slow(x):
+        time.sleep(0.01 * (5 - x))
+        if x == 3:
+            raise ValueError(x)
+        return x * 2
+
+    results = list(imap_bounded(slow, range(5), max_workers=3, ordered=True))
+    assert [item for item, _, _ in results] == [0, 1, 2, 3, 4]
+    assert [res for _, res, exc in results if exc is None] == [0, 2, 4, 8]
+    assert isinstance(results[3][2], ValueError)
+
+
+def test_imap_bounded_unordered():
+    results = list(imap_bounded(lambda x: x + 1, range(20), max_workers=2))
+    assert sorted(res for _, res, _ in results) == list(range(1, 21))
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(50)
+    start = time.time()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.time() - start >= 0.09
+
+
+def test_rate_limiter_invalid():
+    with pytest.raises(ValueError):
+        RateLimiter(0)
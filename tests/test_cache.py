@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+from mapbox.cache import DiskStore, MemoryStore, RouteCache
+
+
+@pytest.fixture(params=['memory', 'disk'])
+def store(request, tmpdir):
+    if request.param == 'memory':
+        return MemoryStore()
+    return DiskStore(str(tmpdir.join('routes')))
+
+
+def test_store_get_set(store):
+    assert store.get('a') is None
+    store.set('a', 'route')
+    assert store.get('a') == 'route'
+    store.delete('a')
+    assert store.get('a') is None
+
+
+def test_store_expires(store):
+    store.set('a', 'route', ttl=0.01)
+    time.sleep(0.02)
+    assert store.get('a') is None
+
+
+def test_memory_store_max_entries():
+    store = MemoryStore(max_entries=2)
+    store.set('a', 1)
+    store.set('b', 2)
+    store.get('a')
+    store.set('c', 3)
+    assert len(store) == 2
+    assert store.get('b') is None
+    assert store.get('a') == 1
+
+
+def test_route_cache_key_quantizes():
+    cache = RouteCache(precision=3)
+    params = {'overview': 'full', 'alternatives': 'false'}
+    key1 = cache.key('mapbox/driving', [(1.00001, 2.0), (3.0, 4.0)], params)
+    key2 = cache.key('mapbox/driving', [(1.0, 2.00002), (3.0, 4.0)], dict(params))
+    assert key1 == key2
+    assert key1 != cache.key('mapbox/walking', [(1.0, 2.0), (3.0, 4.0)], params)
+    assert key1 != cache.key('mapbox/driving', [(1.0, 2.0), (3.0, 4.0)], {})
+
+
+def test_route_cache_ttl():
+    cache = RouteCache(ttl=60, traffic_ttl=5)
+    assert cache.ttl_for('mapbox/driving') == 60
+    assert cache.ttl_for('mapbox/driving-traffic') == 5
@@ -1,5 +1,11 @@
+import json
+import re
+
 from cachecontrol.cache import DictCache
+from mapbox.cache import RouteCache
+from mapbox.services.directions import DirectionsView
 import mapbox
+import polyline
 import pytest
 import responses
 
@@ -271,3 +277,310 @@ def test_validate_snapping():
         [(1, 1, 1), u'unlimited'], [None, None])
 
     assert snaps == ([(1, 1), None], [1, 'unlimited'])
+
+
+def _route_callback(request, offset=0.0):
+    """Builds a route response from the requested waypoints"""
+    path = request.url.split('?')[0].split('/')[-1][:-len('.json')]
+    coords = [[float(v) for v in pair.split('%2C')]
+              for pair in path.split('%3B')]
+    if offset and coords[0][0] != 0.0:
+        coords[0][1] += offset
+    geometry = {'type': 'LineString', 'coordinates': coords}
+    if 'geometries=geojson' not in request.url:
+        geometry = polyline.encode([(lat, lng) for lng, lat in coords])
+    legs = [{'distance': 1.0, 'duration': 2.0, 'steps': [],
+             'annotation': {'distance': [1.0]}} for _ in coords[1:]]
+    body = {
+        'code': 'Ok',
+        'routes': [{
+            'distance': float(len(legs)), 'duration': 2.0 * len(legs),
+            'weight': 2.0 * len(legs), 'weight_name': 'routability',
+            'geometry': geometry,
+            'legs': legs}],
+        'waypoints': [{'location': c, 'name': ''} for c in coords]}
+    return (200, {}, json.dumps(body))
+
+
+@responses.activate
+def test_directions_chunked():
+    """Long routes are requested in chunks and stitched"""
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/driving/.*'),
+        callback=_route_callback, content_type='application/json')
+
+    waypoints = [(0.0 + i * 0.01, 0.0) for i in range(60)]
+    data = mapbox.Directions(access_token='pk.test').directions_chunked(
+        waypoints, geometries='geojson', annotations=['distance'])
+
+    assert len(responses.calls) == 3
+    route = data['routes'][0]
+    assert route['distance'] == 59.0
+    assert route['duration'] == 118.0
+    assert len(route['legs']) == 59
+    assert len(route['geometry']['coordinates']) == 60
+    assert len(data['waypoints']) == 60
+    assert data['seams'] == []
+    fc = data.geojson()
+    assert fc['features'][0]['properties']['distance'] == 59.0
+    assert fc['features'][0]['geometry'] == route['geometry']
+    assert len(data.view().routes[0].legs) == 59
+
+
+@responses.activate
+def test_directions_chunked_polyline_seams():
+    """Polyline geometry is re-encoded and seam mismatches reported"""
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/driving/.*'),
+        callback=lambda request: _route_callback(request, offset=0.001),
+        content_type='application/json')
+
+    waypoints = [(0.0 + i * 0.01, 0.0) for i in range(10)]
+    service = mapbox.Directions(access_token='pk.test')
+    data = service.directions_chunked(waypoints, chunk_size=4)
+
+    assert len(responses.calls) == 3
+    assert [s['waypoint'] for s in data['seams']] == [3, 6]
+    assert data['seams'][0]['distance'] == pytest.approx(111.2, rel=1e-2)
+    fc = data.geojson()
+    assert fc['features'][0]['properties']['distance'] == 9.0
+    # mismatched seams keep both ends
+    assert len(fc['features'][0]['geometry']['coordinates']) == 12
+
+
+def test_directions_chunked_invalid():
+    service = mapbox.Directions(access_token='pk.test')
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        service.directions_chunked(points, chunk_size=26)
+    with pytest.raises(mapbox.errors.InvalidFeatureError):
+        service.directions_chunked(points[:1])
+
+
+@responses.activate
+def test_directions_batch(tmpdir):
+    """Batch routing dedupes pairs and reports failures"""
+    def request_callback(request):
+        if '%2C9.0' in request.url:
+            return (422, {}, '{"message": "InvalidInput"}')
+        return _route_callback(request)
+
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/walking/.*'),
+        callback=request_callback, content_type='application/json')
+
+    pairs = [((0, 0), (1, 1)), ((0, 0), (2, 2)), ((0, 0), (1, 1)),
+             ((0, 0), (9, 9)), ((0, 0), (1, 1))]
+    out = str(tmpdir.join('routes.ndjson'))
+    stats = mapbox.Directions(access_token='pk.test').directions_batch(
+        pairs, out, profile='mapbox/walking', max_workers=2, rate_limit=100)
+
+    assert len(responses.calls) == 3
+    assert 'overview=false' in responses.calls[0].request.url
+    assert stats.succeeded == 4
+    assert stats.failed == 1
+
+    with open(out) as f:
+        results = {r['index']: r for r in (json.loads(line) for line in f)}
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    assert results[0] == {'index': 0, 'distance': 1.0, 'duration': 2.0}
+    assert results[4]['distance'] == 1.0
+    assert results[3]['status'] == 422
+
+
+@responses.activate
+def test_directions_batch_retries_failed_repeats():
+    """A repeat of a pair whose request failed is routed again"""
+    failures = []
+
+    def request_callback(request):
+        if '1.0%2C1.0' in request.url and not failures:
+            failures.append(request.url)
+            return (503, {}, '{"message": "Service unavailable"}')
+        return _route_callback(request)
+
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/driving/.*'),
+        callback=request_callback, content_type='application/json')
+
+    pairs = [((0, 0), (1, 1)), ((0, 0), (2, 2)), ((0, 0), (3, 3)),
+             ((0, 0), (4, 4)), ((0, 0), (1, 1)), ((0, 0), (1, 1))]
+    results = []
+    stats = mapbox.Directions(access_token='pk.test').directions_batch(
+        pairs, results.append, max_workers=1)
+
+    results = {r['index']: r for r in results}
+    assert results[0]['status'] == 503
+    assert results[4]['distance'] == 1.0
+    assert (stats.succeeded, stats.failed) == (5, 1)
+    assert len(failures) == 1
+    assert len(responses.calls) == 5
+
+
+@responses.activate
+def test_directions_batch_invalid_pair():
+    """An invalid pair is reported and does not stop the job"""
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/driving/.*'),
+        callback=_route_callback, content_type='application/json')
+
+    pairs = [((0, 0), (1, 1)), 'bogus', None, ((0, 0), (2, 2)),
+             ((0, 0), (1, 1))]
+    results = []
+    stats = mapbox.Directions(access_token='pk.test').directions_batch(
+        pairs, results.append)
+
+    results = {r['index']: r for r in results}
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    assert 'error' in results[1] and 'error' in results[2]
+    assert results[4]['distance'] == 1.0
+    assert (stats.succeeded, stats.failed) == (3, 2)
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_directions_batch_geometry():
+    """Batch routing can include route geometry"""
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/driving/.*'),
+        callback=_route_callback, content_type='application/json')
+
+    results = []
+    mapbox.Directions(access_token='pk.test').directions_batch(
+        [points], results.append, geometry=True)
+    assert 'overview' not in responses.calls[0].request.url
+    assert polyline.decode(results[0]['geometry']) == [
+        (36.53916, -87.33788), (36.92218, -88.24768)]
+
+
+@responses.activate
+def test_directions_route_cache():
+    """Routes are served from an opt-in route cache"""
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/driving/.*'),
+        callback=_route_callback, content_type='application/json')
+
+    service = mapbox.Directions(
+        access_token='pk.test', route_cache=RouteCache(precision=4))
+    first = service.directions(points, geometries='geojson')
+    nearby = [(-87.33788, 36.53916), (-88.24768, 36.92218)]
+    second = service.directions(nearby, geometries='geojson')
+    assert len(responses.calls) == 1
+    assert second.from_route_cache
+    assert second.status_code == 200
+    assert second.json() == first.json()
+    assert second.geojson()['features'][0]['geometry']['type'] == 'LineString'
+
+    # other options are a different route
+    service.directions(points, geometries='geojson', steps=True)
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_directions_route_cache_generators():
+    """Generators of waypoints have their own cache keys"""
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/driving/.*'),
+        callback=_route_callback, content_type='application/json')
+
+    service = mapbox.Directions(access_token='pk.test', route_cache=RouteCache())
+    first = service.directions(iter([(0, 0), (1, 1)]), geometries='geojson')
+    second = service.directions(iter([(5, 5), (6, 6)]), geometries='geojson')
+    assert len(responses.calls) == 2
+    assert not getattr(second, 'from_route_cache', False)
+    assert second.json() != first.json()
+    third = service.directions(iter([(5, 5), (6, 6)]), geometries='geojson')
+    assert third.from_route_cache
+
+
+@responses.activate
+def test_compare_profiles():
+    """Profiles are compared concurrently"""
+    def request_callback(request):
+        if '/walking/' in request.url:
+            return (422, {}, '{"message": "Route exceeds maximum distance"}')
+        return _route_callback(request)
+
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/.*'),
+        callback=request_callback, content_type='application/json')
+
+    table = mapbox.Directions(access_token='pk.test').compare_profiles(
+        points, geometries='geojson')
+    assert [row['profile'] for row in table] == [
+        'mapbox/cycling', 'mapbox/driving', 'mapbox/driving-traffic',
+        'mapbox/walking']
+    assert table[0]['distance'] == 1.0
+    assert table[0]['geometry']['type'] == 'LineString'
+    assert 'error' in table[3]
+
+
+@responses.activate
+def test_compare_profiles_no_geometry():
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions/v5/mapbox/.*'),
+        callback=_route_callback, content_type='application/json')
+
+    table = mapbox.Directions(access_token='pk.test').compare_profiles(
+        points, profiles=['mapbox/driving', 'mapbox.walking'], geometry=False)
+    assert table == [
+        {'profile': 'mapbox/driving', 'distance': 1.0, 'duration': 2.0},
+        {'profile': 'mapbox/walking', 'distance': 1.0, 'duration': 2.0}]
+    assert all('overview=false' in c.request.url for c in responses.calls)
+
+
+def test_compare_profiles_invalid():
+    with pytest.raises(mapbox.errors.InvalidProfileError):
+        mapbox.Directions().compare_profiles(points, profiles=['bogus'])
+
+
+@responses.activate
+def test_directions_view():
+    """Lazy response view decodes geometry on access"""
+    with open('tests/moors.json') as fh:
+        body = fh.read()
+
+    responses.add(
+        responses.GET,
+        'https://api.mapbox.com/directions/v5/mapbox/driving/'
+        '-87.337875%2C36.539157%3B-88.247681%2C36.922175.json?access_token=pk.test',
+        match_querystring=True,
+        body=body, status=200,
+        content_type='application/json')
+
+    res = mapbox.Directions(access_token='pk.test').directions(points)
+    view = res.view()
+    route = view.routes[0]
+    assert view.code == 'Ok'
+    assert route.duration == res.json()['routes'][0]['duration']
+    assert route._geometry is None
+    assert route.geometry == res.geojson()['features'][0]['geometry']
+    assert route.legs[0].distance == route.distance
+    assert route.legs[0].steps == ()
+    with pytest.raises(AttributeError):
+        route.extra = 1
+    # the response is parsed and wrapped once
+    assert res.view() is view
+    assert res.view().routes[0] is route
+
+
+def test_directions_view_steps():
+    data = {'code': 'Ok', 'routes': [{
+        'distance': 2.0, 'duration': 1.0, 'geometry': '_qo]_qo]',
+        'legs': [{'distance': 2.0, 'duration': 1.0, 'steps': [{
+            'distance': 2.0, 'duration': 1.0, 'name': 'Main St',
+            'maneuver': {'type': 'depart'},
+            'geometry': '_qo]_qo]'}]}]}]}
+    view = DirectionsView(data, geom_format='polyline6')
+    step = view.routes[0].legs[0].steps[0]
+    assert step.name == 'Main St'
+    assert step.geometry['coordinates'] == [(0.5, 0.5)]
@@ -2,8 +2,11 @@
 
 import json
 import re
+import threading
+import time
 import responses
 import pytest
+import requests
 
 import mapbox
 
@@ -371,3 +374,301 @@ def test_geocoder_language():
     response = mapbox.Geocoder(access_token='pk.test').forward(
         '1600 pennsylvania ave nw', languages=['en', 'de'])
     assert response.status_code == 200
+
+
+@responses.activate
+def test_geocoder_forward_bulk(tmpdir):
+    """Bulk forward geocoding writes results and resumes from a journal"""
+
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places/a.json.*'),
+        body='{"query": ["a"]}', status=200,
+        content_type='application/json')
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places/b.json.*'),
+        body='{"message": "Rate limit exceeded"}', status=429,
+        content_type='application/json')
+
+    src = tmpdir.join('addresses.csv')
+    src.write('id,address\n1,a\n2,b\n')
+    out = str(tmpdir.join('out.ndjson'))
+    journal = str(tmpdir.join('journal'))
+
+    geocoder = mapbox.Geocoder(access_token='pk.test')
+    stats = geocoder.forward_bulk(
+        str(src), out, key_field='id', journal=journal, max_workers=2)
+    assert stats.succeeded == 1
+    assert stats.failed == 1
+    assert stats.error_rate == 0.5
+
+    with open(out) as f:
+        results = sorted((json.loads(line) for line in f), key=lambda r: r['key'])
+    assert results[0]['result'] == {'query': ['a']}
+    assert results[1]['status'] == 429
+    assert 'error' in results[1]
+
+    # only the failed record is retried
+    stats = geocoder.forward_bulk(
+        str(src), out, key_field='id', journal=journal)
+    assert stats.skipped == 1
+    assert stats.processed == 1
+
+
+@responses.activate
+def test_geocoder_forward_bulk_missing_field():
+    """Records without the query field are reported as errors"""
+
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places/.*'),
+        body='{"query": []}', status=200,
+        content_type='application/json')
+
+    results = []
+    stats = mapbox.Geocoder(access_token='pk.test').forward_bulk(
+        [{'address': 'a'}, {'addr': 'b'}, {'address': 'c'}], results.append)
+    assert (stats.succeeded, stats.failed) == (2, 1)
+    results = sorted(results, key=lambda r: r['key'])
+    assert [r['key'] for r in results] == [0, 1, 2]
+    assert 'address' in results[1]['error']
+
+
+@responses.activate
+def test_autocomplete_debounce_and_cache():
+    """Autocomplete sends only the latest query and reuses results"""
+
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places/san%20f.json.*'),
+        body='{"query": ["san", "f"]}', status=200,
+        content_type='application/json')
+
+    received = []
+    event = threading.Event()
+
+    def callback(text, result):
+        received.append((text, result))
+        event.set()
+
+    geocoder = mapbox.Geocoder(access_token='pk.test')
+    with geocoder.autocomplete(delay=0.05, lon=-122.4, lat=37.8) as session:
+        for text in ('S', 'Sa', 'San', 'San F'):
+            session.update(text, callback)
+        assert event.wait(5)
+        assert received == [('San F', {'query': ['san', 'f']})]
+        assert len(responses.calls) == 1
+        assert 'proximity=-122.4%2C37.8' in responses.calls[0].request.url
+
+        # backspacing to a seen prefix is served from the cache
+        session.update('san  f', callback)
+        assert len(received) == 2
+        assert session.search('SAN F') == {'query': ['san', 'f']}
+        assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_autocomplete_errback():
+    """Autocomplete request failures are passed to errback"""
+
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places/x.json.*'),
+        body='{"message": "Not Authorized"}', status=401,
+        content_type='application/json')
+
+    errors = []
+    event = threading.Event()
+
+    def errback(text, exc):
+        errors.append(exc)
+        event.set()
+
+    session = mapbox.Geocoder(access_token='pk.test').autocomplete(delay=0)
+    session.update('x', lambda text, result: None, errback=errback)
+    assert event.wait(5)
+    assert len(errors) == 1
+    session.close()
+
+
+def test_validation_tables_are_precomputed():
+    """Country codes and place types are built once"""
+    geocoder = mapbox.Geocoder()
+    assert isinstance(geocoder.country_codes, frozenset)
+    assert geocoder.country_codes is mapbox.Geocoder().country_codes
+    assert geocoder.place_types is mapbox.Geocoder().place_types
+    assert 'us' in geocoder.country_codes
+    with pytest.raises(TypeError):
+        geocoder.place_types['bogus'] = 'Not a place type'
+
+
+@responses.activate
+def test_geocoder_forward_fanout():
+    """Fan-out queries are merged and deduplicated by id"""
+
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places/paris.json.*'),
+        body=json.dumps({"features": [
+            {"id": "place.1", "relevance": 0.9},
+            {"id": "place.2", "relevance": 0.5}]}),
+        status=200, content_type='application/json')
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places-permanent/paris.json.*'),
+        body=json.dumps({"features": [
+            {"id": "place.2", "relevance": 0.8},
+            {"id": "place.3", "relevance": 0.7}]}),
+        status=200, content_type='application/json')
+
+    geocoder = mapbox.Geocoder(access_token='pk.test')
+    fc = geocoder.forward_fanout(
+        'paris', datasets=['mapbox.places', 'mapbox.places-permanent'],
+        variants=[{'country': ['fr']}, {'country': ['us']}], limit=2)
+    assert [(f['id'], f['relevance']) for f in fc['features']] == [
+        ('place.1', 0.9), ('place.2', 0.8), ('place.3', 0.7)]
+    assert len(responses.calls) == 4
+    assert geocoder.name == 'mapbox.places'
+
+
+@responses.activate
+def test_geocoder_forward_fanout_first_relevance():
+    """Fan-out returns early on a high relevance result"""
+
+    def request_callback(request):
+        if 'country=us' in request.url:
+            time.sleep(0.5)
+        body = {"features": [{"id": "place.1", "relevance": 0.99}]}
+        return (200, {}, json.dumps(body))
+
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places/paris.json.*'),
+        callback=request_callback, content_type='application/json')
+
+    start = time.time()
+    fc = mapbox.Geocoder(access_token='pk.test').forward_fanout(
+        'paris', variants=[{'country': ['fr']}, {'country': ['us']}],
+        first_relevance=0.95)
+    assert time.time() - start < 0.4
+    assert [f['id'] for f in fc['features']] == ['place.1']
+
+
+@responses.activate
+def test_geocoder_forward_fanout_all_failed():
+    """Fan-out raises when every query fails"""
+
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/mapbox.places/paris.json.*'),
+        body='{"message": "Not Authorized"}', status=401,
+        content_type='application/json')
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        mapbox.Geocoder(access_token='pk.test').forward_fanout('paris')
+
+
+@responses.activate
+def test_geocoder_forward_fanout_partial_failure():
+    """Failed queries are reported alongside merged features"""
+
+    def request_callback(request):
+        if 'permanent' in request.url:
+            return (401, {}, '{"message": "Not Authorized"}')
+        if 'country=ca' in request.url:
+            raise requests.exceptions.ConnectionError('connection reset')
+        body = {"features": [{"id": "place.1", "relevance": 0.9}]}
+        return (200, {}, json.dumps(body))
+
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/geocoding/v5/.*'),
+        callback=request_callback, content_type='application/json')
+
+    fc = mapbox.Geocoder(access_token='pk.test').forward_fanout(
+        'paris', datasets=['mapbox.places', 'mapbox.places-permanent'],
+        variants=[{'country': ['fr']}, {'country': ['ca']},
+                  {'country': ['bogus']}])
+    assert [f['id'] for f in fc['features']] == ['place.1']
+    failures = sorted(
+        (f['dataset'], f['params']['country'][0], f.get('status'))
+        for f in fc['failures'])
+    assert failures == [
+        ('mapbox.places', 'bogus', None),
+        ('mapbox.places', 'ca', None),
+        ('mapbox.places-permanent', 'bogus', None),
+        ('mapbox.places-permanent', 'ca', 401),
+        ('mapbox.places-permanent', 'fr', 401)]
+    assert all('error' in f for f in fc['failures'])
+
+
+@responses.activate
+def test_geocoder_forward_records():
+    """Forward geocoding results can be projected onto records"""
+
+    body = {"features": [
+        {"id": "place.1", "center": [2.35, 48.85], "place_name": "Paris",
+         "relevance": 0.99, "properties": {"wikidata": "Q90"},
+         "context": [{"id": "country.1", "text": "France"}]},
+        {"id": "place.2", "center": [-95.5, 33.6], "place_name": "Paris, Texas",
+         "relevance": 0.9}]}
+
+    responses.add(
+        responses.GET,
+        'https://api.mapbox.com/geocoding/v5/mapbox.places/paris.json?access_token=pk.test',
+        match_querystring=True,
+        body=json.dumps(body), status=200,
+        content_type='application/json')
+
+    response = mapbox.Geocoder(access_token='pk.test').forward('paris')
+    records = response.records()
+    assert records[0].center == [2.35, 48.85]
+    assert records[0].place_name == 'Paris'
+    assert records[1].relevance == 0.9
+
+    records = response.records(('place_name', 'properties.wikidata'))
+    assert records == [('Paris', 'Q90'), ('Paris, Texas', None)]
+    assert records[0].properties_wikidata == 'Q90'
+
+
+@responses.activate
+def test_geocoder_records_cached(monkeypatch):
+    """records() projects the response once per sequence of fields"""
+
+    responses.add(
+        responses.GET,
+        'https://api.mapbox.com/geocoding/v5/mapbox.places/-77.0,38.0.json?access_token=pk.test',
+        match_querystring=True,
+        body='{"features": [{"place_name": "A"}]}', status=200,
+        content_type='application/json')
+
+    response = mapbox.Geocoder(access_token='pk.test').reverse(-77.0, 38.0)
+    calls = []
+    json_ = response.json
+    monkeypatch.setattr(
+        response, 'json', lambda: calls.append(1) or json_())
+    response.records()
+    assert response.records() == [(None, 'A', None)]
+    assert len(calls) == 1
+    response.records(['place_name'])
+    assert response.records(('place_name',)) == [('A',)]
+    assert len(calls) == 2
+
+
+def test_project_features_awkward_fields():
+    """Fields that are not identifiers or collide are renamed"""
+    data = {'features': [{'properties': {'short-code': 'us', 'class': 1},
+                          'a_b': 2, 'a': {'b': 3}, '1st': 4}]}
+    fields = ('properties.short-code', 'properties.class', 'a_b', 'a.b',
+              'class', '1st')
+    record, = mapbox.services.geocoding.project_features(data, fields)
+    assert record == ('us', 1, 2, 3, None, 4)
+    assert record.properties_short_code == 'us'
+    assert record.properties_class == 1
+    assert record.a_b == 2
+    assert record._fields[3:] == ('_3', '_4', '_5')
+
+
+def test_project_features_empty():
+    assert mapbox.services.geocoding.project_features({}) == []
@@ -1,7 +1,14 @@
+import json
+import re
+import time
+from urllib.parse import parse_qs
+
 import pytest
+import requests
 import responses
 
 import mapbox
+from mapbox.services.mapmatching import StreamingMatcher, preprocess_trace
 
 @pytest.fixture
 def line_feature():
@@ -77,3 +84,416 @@ def test_invalid_profile(line_feature):
     service = mapbox.MapMatcher(access_token='pk.test')
     with pytest.raises(ValueError):
         service.match(line_feature, profile="covered_wagon")
+
+
+def _match_callback(request):
+    """Matches every point to itself"""
+    feature = json.loads(request.body)
+    coords = feature['geometry']['coordinates']
+    assert len(coords) <= 100
+    times = feature['properties'].get('coordTimes')
+    assert times is None or len(times) == len(coords)
+    body = {'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature',
+        'properties': {'confidence': 0.9, 'matchedPoints': coords,
+                       'indices': list(range(len(coords)))},
+        'geometry': {'type': 'LineString', 'coordinates': coords}}]}
+    return (200, {}, json.dumps(body))
+
+
+@pytest.fixture
+def long_feature():
+    coords = [[13.0 + i * 0.0001, 52.5] for i in range(250)]
+    return {
+        'type': 'Feature',
+        'properties': {'coordTimes': [str(i) for i in range(250)]},
+        'geometry': {'type': 'LineString', 'coordinates': coords}}
+
+
+@responses.activate
+def test_match_long(long_feature):
+    responses.add_callback(
+        responses.POST,
+        'https://api.mapbox.com/matching/v4/mapbox.driving.json',
+        callback=_match_callback, content_type='application/json')
+
+    service = mapbox.MapMatcher(access_token='pk.test')
+    fc = service.match_long(long_feature, window=100, overlap=20)
+    assert len(responses.calls) == 3
+    matched = fc['features'][0]
+    assert matched['properties']['indices'] == list(range(250))
+    assert matched['geometry']['coordinates'] == \
+        long_feature['geometry']['coordinates']
+    windows = matched['properties']['windows']
+    assert [(w['start'], w['end']) for w in windows] == [
+        (0, 100), (80, 180), (160, 250)]
+    assert windows[0]['confidence'] == [0.9]
+
+
+@responses.activate
+def test_match_long_single_point_tail(long_feature):
+    """Without overlap, a last window of one point is shifted back"""
+    responses.add_callback(
+        responses.POST,
+        'https://api.mapbox.com/matching/v4/mapbox.driving.json',
+        callback=_match_callback, content_type='application/json')
+
+    coords = long_feature['geometry']['coordinates'][:201]
+    feature = {'type': 'Feature', 'properties': {},
+               'geometry': {'type': 'LineString', 'coordinates': coords}}
+    fc = mapbox.MapMatcher(access_token='pk.test').match_long(
+        feature, window=100, overlap=0)
+    sizes = [len(json.loads(call.request.body)['geometry']['coordinates'])
+             for call in responses.calls]
+    assert sorted(sizes) == [2, 100, 100]
+    matched = fc['features'][0]
+    assert matched['properties']['indices'] == list(range(201))
+    assert matched['geometry']['coordinates'] == coords
+    assert [(w['start'], w['end'])
+            for w in matched['properties']['windows']] == [
+        (0, 100), (100, 200), (199, 201)]
+
+
+@responses.activate
+def test_match_long_short_trace(line_feature):
+    responses.add_callback(
+        responses.POST,
+        'https://api.mapbox.com/matching/v4/mapbox.driving.json',
+        callback=_match_callback, content_type='application/json')
+
+    fc = mapbox.MapMatcher(access_token='pk.test').match_long(line_feature)
+    assert len(responses.calls) == 1
+    assert fc['features'][0]['properties']['indices'] == [0, 1, 2, 3, 4]
+
+
+def test_match_long_invalid(long_feature):
+    service = mapbox.MapMatcher(access_token='pk.test')
+    with pytest.raises(mapbox.errors.InvalidFeatureError):
+        service.match_long({'type': 'Feature', 'geometry': {'type': 'Point'}})
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        service.match_long(long_feature, window=101)
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        service.match_long(long_feature, window=10, overlap=10)
+
+
+def test_preprocess_trace_min_distance():
+    coords = [[13.0, 52.5], [13.00001, 52.5], [13.00002, 52.50001],
+              [13.001, 52.5], [13.001, 52.50001]]
+    feature = {'type': 'Feature', 'properties': {'coordTimes': [0, 1, 2, 3, 4]},
+               'geometry': {'type': 'LineString', 'coordinates': coords}}
+    reduced, indices = preprocess_trace(feature, min_distance=5)
+    assert indices == [0, 3, 4]
+    assert reduced['geometry']['coordinates'] == [coords[i] for i in indices]
+    assert reduced['properties']['coordTimes'] == [0, 3, 4]
+    assert feature['geometry']['coordinates'] == coords
+
+
+def test_preprocess_trace_max_speed(line_feature):
+    line_feature['geometry']['coordinates'][2] = [13.5, 52.5]
+    reduced, indices = preprocess_trace(line_feature, max_speed=50)
+    assert indices == [0, 1, 3, 4]
+
+
+def test_preprocess_trace_max_speed_requires_times(line_feature):
+    del line_feature['properties']['coordTimes']
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        preprocess_trace(line_feature, max_speed=50)
+
+
+@pytest.mark.parametrize('method', ['douglas-peucker', 'visvalingam'])
+def test_preprocess_trace_simplify(method):
+    # a straight road with a dense fix every ~7 m and one corner
+    coords = [[13.0 + i * 0.0001, 52.5] for i in range(50)]
+    coords += [[13.0049, 52.5 + i * 0.0001] for i in range(1, 50)]
+    feature = {'type': 'Feature', 'properties': {},
+               'geometry': {'type': 'LineString', 'coordinates': coords}}
+    reduced, indices = preprocess_trace(feature, tolerance=2, method=method)
+    assert indices == [0, 49, 98]
+
+
+def test_preprocess_trace_invalid_method(line_feature):
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        preprocess_trace(line_feature, tolerance=1, method='bogus')
+
+
+def _stream_responses():
+    responses.add_callback(
+        responses.POST,
+        'https://api.mapbox.com/matching/v4/mapbox.driving.json',
+        callback=_match_callback, content_type='application/json')
+
+
+@responses.activate
+def test_streaming_matcher_windows():
+    _stream_responses()
+    segments = {}
+    stream = StreamingMatcher(
+        mapbox.MapMatcher(access_token='pk.test'),
+        lambda vehicle, seg: segments.setdefault(vehicle, []).append(seg),
+        window=10, overlap=3, max_workers=4)
+    for i in range(25):
+        for vehicle in ('a', 'b'):
+            stream.push(vehicle, 13.0 + i * 0.0001, 52.5, str(i))
+    stream.close()
+
+    for vehicle in ('a', 'b'):
+        indices = [i for seg in segments[vehicle] for i in seg['indices']]
+        assert indices == list(range(25))
+        first, second = segments[vehicle][:2]
+        # the second segment starts where the first ended
+        assert second['geometry']['coordinates'][0] == \
+            first['geometry']['coordinates'][-1]
+    # each request carries at most 10 fixes, 3 of them context
+    assert all(len(json.loads(call.request.body)['geometry']['coordinates'])
+               <= 10 for call in responses.calls)
+
+
+@responses.activate
+def test_streaming_matcher_latency():
+    _stream_responses()
+    segments = []
+    stream = StreamingMatcher(
+        mapbox.MapMatcher(access_token='pk.test'),
+        lambda vehicle, seg: segments.append(seg),
+        window=50, max_latency=5.0)
+    stream.push('a', 13.0, 52.5)
+    stream.push('a', 13.0001, 52.5)
+    stream.poll(now=time.time())
+    assert len(responses.calls) == 0
+    stream.poll(now=time.time() + 10)
+    stream.close()
+    assert len(responses.calls) == 1
+    assert segments[0]['indices'] == [0, 1]
+    assert 'coordTimes' not in json.loads(responses.calls[0].request.body)[
+        'properties']
+
+
+@responses.activate
+def test_streaming_matcher_overdue():
+    """A stream that was due while it had a single fix is matched as soon
+    as it can be, and poll() only visits streams that are due"""
+    _stream_responses()
+    stream = StreamingMatcher(
+        mapbox.MapMatcher(access_token='pk.test'), lambda v, s: None,
+        window=50, max_latency=5.0)
+    for vehicle in range(100):
+        stream.push(vehicle, 13.0, 52.5)
+    stream.push('a', 13.0, 52.5)
+    stream.poll(now=time.time())
+    assert len(stream._deadlines) == 101
+    stream.poll(now=time.time() + 10)
+    assert not stream._deadlines
+    assert stream._streams['a'].pending
+    stream.push('a', 13.0001, 52.5)
+    assert not stream._streams['a'].pending
+    stream.close()
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_streaming_matcher_errback():
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/matching/v4/mapbox.driving.json',
+        status=422, body='{}', content_type='application/json')
+    failures = []
+    stream = StreamingMatcher(
+        mapbox.MapMatcher(access_token='pk.test'), lambda v, s: None,
+        window=5, overlap=0, errback=lambda vehicle, exc: failures.append(vehicle))
+    for i in range(5):
+        stream.push('a', 13.0 + i * 0.0001, 52.5)
+    stream.close()
+    assert failures == ['a']
+
+
+def test_streaming_matcher_invalid_window():
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        StreamingMatcher(mapbox.MapMatcher(access_token='pk.test'),
+                         lambda v, s: None, window=101)
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        StreamingMatcher(mapbox.MapMatcher(access_token='pk.test'),
+                         lambda v, s: None, window=10, overlap=9)
+
+
+V5_BODY = {
+    'code': 'Ok',
+    'tracepoints': [],
+    'matchings': [{
+        'confidence': 0.8, 'distance': 42.0, 'duration': 10.0,
+        'geometry': '_qo]_qo]'}]}
+
+
+@responses.activate
+def test_match_v5_get(line_feature):
+    responses.add(
+        responses.GET,
+        re.compile(r'https://api\.mapbox\.com/matching/v5/mapbox/driving/.*'),
+        json=V5_BODY, status=200)
+
+    service = mapbox.MapMatcherV5(access_token='pk.test')
+    res = service.match(line_feature, radiuses=[10] * 5,
+                        annotations=['speed'])
+    assert res.status_code == 200
+    url = responses.calls[0].request.url
+    assert '/mapbox/driving/13.418947%2C52.500559%3B' in url
+    assert 'geometries=polyline6' in url
+    assert 'annotations=speed' in url
+    assert 'radiuses=10%3B10%3B10%3B10%3B10' in url
+    assert 'timestamps=' in url
+
+    feature = res.geojson()['features'][0]
+    assert feature['properties']['confidence'] == 0.8
+    assert feature['geometry']['coordinates'] == [(0.5, 0.5)]
+
+
+@responses.activate
+def test_match_v5_post_long_url():
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/matching/v5/mapbox/cycling',
+        json=V5_BODY, status=200)
+
+    coords = [[13.123456 + i * 0.0001, 52.123456] for i in range(100)]
+    service = mapbox.MapMatcherV5(access_token='pk.test')
+    service.max_url_length = 1024
+    res = service.match(coords, profile='mapbox/cycling',
+                        timestamps=range(100))
+    assert res.status_code == 200
+    body = parse_qs(responses.calls[0].request.body)
+    assert len(body['coordinates'][0].split(';')) == 100
+    assert body['timestamps'][0].startswith('0;1;2')
+    assert body['geometries'] == ['polyline6']
+
+
+@responses.activate
+def test_match_v5_post_long_token(line_feature):
+    """The session's access token counts towards the URL length"""
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/matching/v5/mapbox/driving',
+        json=V5_BODY, status=200)
+
+    service = mapbox.MapMatcherV5(access_token='pk.' + 'a' * 2000)
+    service.max_url_length = 2048
+    res = service.match(line_feature)
+    assert res.status_code == 200
+    assert 'access_token=pk.aaa' in responses.calls[0].request.url
+
+
+@responses.activate
+def test_match_v5_null_properties(line_feature):
+    responses.add(
+        responses.GET,
+        re.compile(r'https://api\.mapbox\.com/matching/v5/mapbox/driving/.*'),
+        json=V5_BODY, status=200)
+
+    line_feature['properties'] = None
+    res = mapbox.MapMatcherV5(access_token='pk.test').match(line_feature)
+    assert res.status_code == 200
+    assert 'timestamps=' not in responses.calls[0].request.url
+
+
+def test_match_v5_validation(line_feature):
+    service = mapbox.MapMatcherV5(access_token='pk.test')
+    with pytest.raises(mapbox.errors.InvalidProfileError):
+        service.match(line_feature, profile='mapbox/flying')
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        service.match(line_feature, annotations=['congestion'])
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        service.match(line_feature, radiuses=[10])
+    with pytest.raises(mapbox.errors.InvalidParameterError):
+        service.match(line_feature, radiuses=[-1] * 5)
+    with pytest.raises(mapbox.errors.InvalidFeatureError):
+        service.match([[0, 0]] * 101)
+
+
+@responses.activate
+def test_match_batch(tmpdir, line_feature):
+    state = {'calls': 0}
+
+    def callback(request):
+        feature = json.loads(request.body)
+        if feature['id'] == 'flaky':
+            state['calls'] += 1
+            if state['calls'] == 1:
+                return (503, {}, 'unavailable')
+        if feature['id'] == 'bad':
+            return (422, {}, '{"message": "invalid"}')
+        return _match_callback(request)
+
+    responses.add_callback(
+        responses.POST,
+        'https://api.mapbox.com/matching/v4/mapbox.driving.json',
+        callback=callback, content_type='application/json')
+
+    src = tmpdir.join('traces.ndjson')
+    lines = []
+    for fid in ('a', 'flaky', 'bad', 'b'):
+        lines.append(json.dumps(dict(line_feature, id=fid)))
+    src.write('\n'.join(lines) + '\n')
+    dst = tmpdir.join('matched.ndjson')
+
+    service = mapbox.MapMatcher(access_token='pk.test')
+    stats = service.match_batch(str(src), str(dst), max_workers=3,
+                                backoff=0.01)
+    assert (stats.succeeded, stats.failed) == (3, 1)
+
+    results = [json.loads(line) for line in dst.readlines()]
+    assert [r['id'] for r in results] == ['a', 'flaky', 'bad', 'b']
+    assert [r['index'] for r in results] == [0, 1, 2, 3]
+    assert results[2]['status'] == 422
+    assert results[1]['features'][0]['properties']['confidence'] == 0.9
+    # the 503 was retried, the 422 was not
+    assert state['calls'] == 2
+    assert len(responses.calls) == 5
+
+
+@responses.activate
+def test_match_batch_retries_timeouts(line_feature):
+    state = {'calls': 0}
+
+    def callback(request):
+        state['calls'] += 1
+        if state['calls'] == 1:
+            raise requests.exceptions.ReadTimeout('read timed out')
+        return _match_callback(request)
+
+    responses.add_callback(
+        responses.POST,
+        'https://api.mapbox.com/matching/v4/mapbox.driving.json',
+        callback=callback, content_type='application/json')
+
+    results = []
+    service = mapbox.MapMatcher(access_token='pk.test')
+    stats = service.match_batch([line_feature], results.append, backoff=0.01)
+    assert (stats.succeeded, stats.failed) == (1, 0)
+    assert state['calls'] == 2
+
+
+@responses.activate
+def test_match_batch_invalid_feature():
+    results = []
+    service = mapbox.MapMatcher(access_token='pk.test')
+    stats = service.match_batch([{'type': 'Feature'}], results.append)
+    assert stats.failed == 1
+    assert 'error' in results[0]
+    assert len(responses.calls) == 0
+
+
+@pytest.mark.parametrize('overlap', [0, 3])
+@responses.activate
+def test_streaming_matcher_close_single_fix(overlap):
+    _stream_responses()
+    segments = []
+    failures = []
+    stream = StreamingMatcher(
+        mapbox.MapMatcher(access_token='pk.test'),
+        lambda vehicle, seg: segments.append(seg), window=5, overlap=overlap,
+        errback=lambda vehicle, exc: failures.append((vehicle, exc)))
+    stream.push('car', 13.0, 52.5)
+    for i in range(6):
+        stream.push('bus', 13.0 + i * 0.0001, 52.5)
+    stream.close()
+    assert [vehicle for vehicle, _ in failures] == ['car'] + (
+        ['bus'] if overlap == 0 else [])
+    assert isinstance(failures[0][1], mapbox.errors.InvalidFeatureError)
@@ -1,8 +1,15 @@
+import json
+import re
+import time
+
 import pytest
 import responses
 
 from mapbox import DirectionsMatrix
-from mapbox.errors import MapboxDeprecationWarning
+import mapbox.services.matrix
+from mapbox.services.matrix import (
+    IncrementalMatrix, TiledMatrix, plan_pairs, shortlist_nearest)
+from mapbox.errors import InvalidParameterError, MapboxDeprecationWarning
 
 
 points = [{
@@ -98,4 +105,359 @@ def test_matrix(waypoints, annotations):
     matrix = res.json()['durations']
     # 3x3 list
     assert len(matrix) == 3
-    assert len(matrix[0]) == 3
\ No newline at end of file
+    assert len(matrix[0]) == 3
+
+
+def _matrix_callback(request, fail=None):
+    """Durations are 1000 * source lon + destination lon"""
+    path, _, query = request.url.partition('?')
+    coords = [[float(v) for v in pair.split(',')]
+              for pair in path.split('/')[-1].replace('%2C', ',').split(';')]
+    params = dict(p.split('=') for p in query.split('&'))
+    srcs = [int(i) for i in params['sources'].replace('%3B', ';').split(';')]
+    dsts = [int(i) for i in params['destinations'].replace('%3B', ';').split(';')]
+    if fail is not None and fail(coords):
+        return (500, {}, '{"message": "Server error"}')
+    durations = [[None if coords[s][1] < 0 else 1000 * coords[s][0] + coords[d][0]
+                  for d in dsts] for s in srcs]
+    distances = [[2 * v if v is not None else None for v in row] for row in durations]
+    return (200, {}, json.dumps({'code': 'Ok', 'durations': durations,
+                                 'distances': distances}))
+
+
+@responses.activate
+def test_matrix_tiled():
+    np = pytest.importorskip('numpy')
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving-traffic/.*'),
+        callback=_matrix_callback, content_type='application/json')
+
+    coords = [(i, 0 if i != 7 else -1) for i in range(12)]
+    progress = []
+    result = DirectionsMatrix(access_token='pk.test').matrix_tiled(
+        coords, profile='mapbox/driving-traffic', sources=range(1, 12),
+        annotations=['duration', 'distance'], rate_limit=1000,
+        progress=lambda done, total: progress.append((done, total)))
+
+    # driving-traffic allows 10 coordinates: blocks of 5
+    assert len(responses.calls) == 9
+    assert progress[-1] == (9, 9)
+    assert result.complete
+    assert result.durations.shape == (11, 12)
+    assert result.durations[0, 3] == 1003
+    assert result.durations[10, 11] == 11011
+    assert np.isnan(result.durations[6]).all()
+    assert result.distances[0, 3] == 2006
+
+
+@responses.activate
+def test_matrix_tiled_resume():
+    pytest.importorskip('numpy')
+    outage = {'on': True}
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving/.*'),
+        callback=lambda r: _matrix_callback(
+            r, fail=lambda c: outage['on'] and c[0][0] == 0),
+        content_type='application/json')
+
+    service = DirectionsMatrix(access_token='pk.test')
+    coords = [(i, 0) for i in range(4)]
+    result = service.matrix_tiled(coords, block_size=2)
+    assert set(result.failed) == {(0, 0), (0, 2)}
+    assert not result.complete
+
+    outage['on'] = False
+    result = service.matrix_tiled(coords, block_size=2, result=result)
+    assert len(responses.calls) == 6
+    assert result.complete
+    assert result.failed == {}
+    assert result.durations[0, 1] == 1
+
+
+def test_matrix_tiled_block_size():
+    pytest.importorskip('numpy')
+    with pytest.raises(InvalidParameterError):
+        DirectionsMatrix().matrix_tiled(points, block_size=13)
+
+
+def test_annotations_invalid():
+    with pytest.raises(InvalidParameterError):
+        DirectionsMatrix()._validate_annotations(['speed'])
+
+
+@responses.activate
+def test_matrix_tiled_memmap(tmpdir):
+    np = pytest.importorskip('numpy')
+    outage = {'on': True}
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving/.*'),
+        callback=lambda r: _matrix_callback(
+            r, fail=lambda c: outage['on'] and c[0][0] == 2),
+        content_type='application/json')
+
+    out = str(tmpdir.join('matrix'))
+    service = DirectionsMatrix(access_token='pk.test')
+    coords = [(i, 0) for i in range(4)]
+    with service.matrix_tiled(coords, block_size=2, out=out,
+                              annotations=['duration', 'distance']) as result:
+        assert set(result.failed) == {(2, 0), (2, 2)}
+    assert sorted(tmpdir.join('matrix').listdir()) == [
+        tmpdir.join('matrix', name)
+        for name in ('distances.npy', 'durations.npy', 'job.json',
+                     'tiles.journal')]
+
+    # a new job with the same out directory only computes missing tiles
+    outage['on'] = False
+    with service.matrix_tiled(coords, block_size=2, out=out,
+                              annotations=['duration', 'distance']) as result:
+        assert result.complete
+    assert len(responses.calls) == 6
+
+    durations = np.load(str(tmpdir.join('matrix', 'durations.npy')))
+    assert durations[3, 1] == 3001
+    assert durations[0, 3] == 3
+
+
+@responses.activate
+def test_matrix_tiled_memmap_journal_closed(tmpdir):
+    """The tile journal is closed when the call returns"""
+    pytest.importorskip('numpy')
+    outage = {'on': True}
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving/.*'),
+        callback=lambda r: _matrix_callback(
+            r, fail=lambda c: outage['on'] and c[0][0] == 2),
+        content_type='application/json')
+
+    out = tmpdir.join('matrix')
+    service = DirectionsMatrix(access_token='pk.test')
+    coords = [(i, 0) for i in range(4)]
+    result = service.matrix_tiled(coords, block_size=2, out=str(out))
+    assert result._journal is None
+    assert len(out.join('tiles.journal').readlines()) == 2
+
+    # resuming with the result reopens the journal while it runs
+    outage['on'] = False
+    result = service.matrix_tiled(coords, block_size=2, out=str(out),
+                                  result=result)
+    assert result.complete and result._journal is None
+    assert len(out.join('tiles.journal').readlines()) == 4
+    result.close()
+
+
+def test_matrix_tiled_memmap_shape_mismatch(tmpdir):
+    pytest.importorskip('numpy')
+    out = str(tmpdir.join('matrix'))
+    TiledMatrix((2, 2), ['duration'], 1, out=out).close()
+    with pytest.raises(ValueError):
+        TiledMatrix((3, 3), ['duration'], 1, out=out)
+
+
+@responses.activate
+@pytest.mark.parametrize('changed', [
+    {'block_size': 1},
+    {'sources': [1, 0, 2, 3]},
+    {'annotations': ['duration', 'distance']},
+    {'profile': 'mapbox/walking'},
+    {'coordinates': [(i, 1) for i in range(4)]}])
+def test_matrix_tiled_memmap_job_mismatch(tmpdir, changed):
+    pytest.importorskip('numpy')
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/.*'),
+        callback=_matrix_callback, content_type='application/json')
+
+    out = str(tmpdir.join('matrix'))
+    service = DirectionsMatrix(access_token='pk.test')
+    kwargs = {'coordinates': [(i, 0) for i in range(4)], 'block_size': 2,
+              'out': out}
+    service.matrix_tiled(**kwargs).close()
+    kwargs.update(changed)
+    with pytest.raises(ValueError) as exc:
+        service.matrix_tiled(**kwargs)
+    assert 'different' in str(exc.value)
+
+
+def test_matrix_tiled_memmap_foreign_directory(tmpdir):
+    pytest.importorskip('numpy')
+    tmpdir.join('durations.npy').write('')
+    with pytest.raises(ValueError):
+        TiledMatrix((2, 2), ['duration'], 1, out=str(tmpdir))
+
+
+def _covered(plan):
+    return set((s, d) for srcs, dsts in plan for s in srcs for d in dsts)
+
+
+def test_plan_pairs():
+    pairs = [(0, 5), (1, 5), (2, 5), (0, 6), (1, 6), (3, 3)]
+    plan = plan_pairs(pairs, limit=25)
+    assert len(plan) == 1
+    assert set(pairs) <= _covered(plan)
+
+
+def test_plan_pairs_limit():
+    pairs = [(s, d) for s in range(10) for d in range(100, 130)]
+    pairs += [(200, 200), (200, 201)]
+    plan = plan_pairs(pairs, limit=10)
+    assert set(pairs) <= _covered(plan)
+    for srcs, dsts in plan:
+        assert len(set(srcs) | set(dsts)) <= 10
+    # each source's 30 destinations need 4 requests of 9
+    assert len(plan) <= 10 * 4 + 1
+
+
+def test_plan_pairs_many():
+    pairs = [((i * 7919) % 3000, (i * 104729) % 3000) for i in range(20000)]
+    plan = plan_pairs(pairs, limit=25)
+    assert set(pairs) <= _covered(plan)
+    for srcs, dsts in plan:
+        assert len(set(srcs) | set(dsts)) <= 25
+
+
+def test_plan_pairs_invalid():
+    with pytest.raises(InvalidParameterError):
+        plan_pairs([(0, 1)], limit=1)
+
+
+@responses.activate
+def test_matrix_pairs():
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving/.*'),
+        callback=_matrix_callback, content_type='application/json')
+
+    coords = [(i, 0) for i in range(40)]
+    pairs = [(0, 30), (1, 31), (0, 31), (2, 39), (5, 5)]
+    cells = DirectionsMatrix(access_token='pk.test').matrix_pairs(
+        coords, pairs, annotations=['duration', 'distance'])
+    assert len(responses.calls) == 1
+    assert set(cells) == set(pairs)
+    assert cells[(0, 31)] == {'duration': 31, 'distance': 62}
+    assert cells[(2, 39)]['duration'] == 2039
+
+
+@responses.activate
+def test_matrix_pairs_failure():
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/walking/.*'),
+        body='{"message": "Server error"}', status=500,
+        content_type='application/json')
+
+    cells = DirectionsMatrix(access_token='pk.test').matrix_pairs(
+        [(0, 0), (1, 1)], [(0, 1)], profile='mapbox/walking')
+    assert 'error' in cells[(0, 1)]
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_shortlist_nearest(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(mapbox.services.matrix, 'np', None)
+    sources = [(0, 0), (10, 10)]
+    candidates = [(10, 10.1), (0, 0.5), (0, 0.1), (50, 50)]
+    shortlist = shortlist_nearest(sources, candidates, 2)
+    assert [j for j, _ in shortlist[0]] == [2, 1]
+    assert [j for j, _ in shortlist[1]] == [0, 1]
+    assert shortlist[0][0][1] == pytest.approx(11119.5, rel=1e-4)
+    assert shortlist_nearest(sources, candidates, 10)[0][-1][0] == 3
+    assert shortlist_nearest([], candidates, 2) == []
+
+
+def test_shortlist_nearest_chunked():
+    pytest.importorskip('numpy')
+    sources = [(i * 0.7, i * -0.3) for i in range(25)]
+    candidates = [(j * 0.5, j * -0.2) for j in range(40)]
+    assert (shortlist_nearest(sources, candidates, 3, max_cells=100) ==
+            shortlist_nearest(sources, candidates, 3))
+    assert (shortlist_nearest(sources, candidates, 3, max_cells=1) ==
+            shortlist_nearest(sources, candidates, 3))
+
+
+@responses.activate
+def test_nearest():
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving/.*'),
+        callback=_matrix_callback, content_type='application/json')
+
+    # durations from the callback grow with candidate longitude
+    sources = [(0, 0), (1, 1)]
+    candidates = [(5, 0), (3, 0.5), (2, 1), (9, 9), (80, 80)]
+    results = DirectionsMatrix(access_token='pk.test').nearest(
+        sources, candidates, k=2, shortlist=3)
+    assert len(responses.calls) == 1
+    assert [r['candidate'] for r in results[0]] == [2, 1]
+    assert results[0][0]['duration'] == 2
+    assert results[1][0]['duration'] == 1002
+    assert all(r['candidate'] != 4 for row in results for r in row)
+
+
+@responses.activate
+def test_incremental_matrix():
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving/.*'),
+        callback=_matrix_callback, content_type='application/json')
+
+    matrix = IncrementalMatrix(DirectionsMatrix(access_token='pk.test'))
+    assert matrix.ttl is None
+    matrix.add('a', (1, 0))
+    matrix.add('b', {'type': 'Point', 'coordinates': (2, 0)})
+    assert matrix.update() == {}
+    assert matrix.durations() == (['a', 'b'], [[0.0, 1002], [2001, 0.0]])
+
+    calls = len(responses.calls)
+    matrix.add('c', (3, 0))
+    assert len(matrix.missing()) == 4
+    matrix.update()
+    assert len(responses.calls) == calls + 1
+    assert matrix.get('c', 'a') == 3001
+
+    # nothing to fetch after a removal
+    matrix.remove('b')
+    assert matrix.missing() == []
+    assert matrix.update() == {}
+    assert len(responses.calls) == calls + 1
+    assert matrix.durations()[0] == ['a', 'c']
+
+
+@responses.activate
+def test_incremental_matrix_ttl():
+    responses.add_callback(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving-traffic/.*'),
+        callback=_matrix_callback, content_type='application/json')
+
+    matrix = IncrementalMatrix(
+        DirectionsMatrix(access_token='pk.test'), 'mapbox/driving-traffic')
+    assert matrix.ttl == 300
+    matrix.ttl = 0.01
+    matrix.add('a', (1, 0))
+    matrix.add('b', (2, 0))
+    matrix.update()
+    assert matrix.missing() == []
+    time.sleep(0.02)
+    assert len(matrix.missing()) == 2
+
+
+@responses.activate
+def test_incremental_matrix_failure():
+    responses.add(
+        responses.GET,
+        re.compile('https://api.mapbox.com/directions-matrix/v1/mapbox/driving/.*'),
+        body='{"message": "Server error"}', status=500,
+        content_type='application/json')
+
+    matrix = IncrementalMatrix(DirectionsMatrix(access_token='pk.test'))
+    matrix.add('a', (1, 0))
+    matrix.add('b', (2, 0))
+    assert len(matrix.update()) == 2
+    assert matrix.get('a', 'b') is None
+    assert len(matrix.missing()) == 2
@@ -1,11 +1,18 @@
 import base64
+import gzip
+import hashlib
 import json
+import re
+import time
 
+from boto3.exceptions import S3UploadFailedError
+import requests
 import responses
 import pytest
 
 import mapbox
 import mapbox.services.uploads
+from mapbox.services.uploads import FeatureStream, UploadManifest, file_digest
 
 
 username = 'testuser'
@@ -175,15 +182,22 @@ def test_delete():
 class MockSession(object):
     """Mocks a boto3 session."""
 
+    instances = 0
+
     def __init__(self, *args, **kwargs):
         self.bucket = None
         self.key = None
-        pass
+        self.kwargs = kwargs
+        MockSession.instances += 1
 
     def resource(self, name):
         self.resource_name = name
         return self
 
+    def client(self, name):
+        self.resource_name = name
+        return self
+
     def Object(self, bucket, key):
         assert self.resource_name == 's3'
         self.bucket = bucket
@@ -205,15 +219,20 @@ class MockSession(object):
         self.key = key
         self.Callback = Callback
 
-    def upload_fileobj(self, data, key, Callback=None):
+    def upload_fileobj(self, data, bucket, key, Callback=None, Config=None):
         self.data = data
+        self.bucket = bucket
         self.key = key
         self.Callback = Callback
+        self.Config = Config
+        MockSession.last = self
 
+        self.received = b''
         bytes_read = data.read(8192)
         if bytes_read and self.Callback:
             self.Callback(len(bytes_read))
         while bytes_read:
+            self.received += bytes_read
             bytes_read = data.read(8192)
             if bytes_read and self.Callback:
                 self.Callback(len(bytes_read))
@@ -506,3 +525,614 @@ def test_create_tileset_validation():
     with pytest.raises(mapbox.errors.ValidationError):
         mapbox.Uploader(access_token=access_token).create(
             'http://example.com/test.json', 'a' * 60)
+
+
+@responses.activate
+def test_stage_transfer_config(monkeypatch):
+    """Transfer settings are passed to boto3 and progress is reported"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+
+    reports = []
+    byte_counts = []
+
+    def report(progress):
+        reports.append((progress.transferred, progress.fraction,
+                        progress.throughput))
+
+    with open('tests/moors.json', 'rb') as src:
+        size = len(src.read())
+        src.seek(0)
+        mapbox.Uploader(access_token=access_token).stage(
+            src, callback=byte_counts.append, progress=report,
+            multipart_threshold=16 * 1024 * 1024,
+            multipart_chunksize=16 * 1024 * 1024,
+            max_concurrency=20, max_bandwidth=1000000)
+
+    config = MockSession.last.Config
+    assert config.multipart_threshold == 16 * 1024 * 1024
+    assert config.multipart_chunksize == 16 * 1024 * 1024
+    assert config.max_concurrency == 20
+    assert config.max_bandwidth == 1000000
+
+    assert sum(byte_counts) == size
+    assert reports[-1][0] == size
+    assert reports[-1][1] == 1.0
+    assert all(throughput >= 0 for _, _, throughput in reports)
+
+
+@responses.activate
+def test_stage_default_transfer_config(monkeypatch):
+    """Boto3's default transfer settings are used by default"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    creds = {
+        'key': '_pending/{0}/key.test'.format(username),
+        'accessKeyId': 'ak.test',
+        'bucket': 'tilestream-tilesets-production',
+        'url': 'https://example.com/key.test',
+        'secretAccessKey': 'sak.test',
+        'sessionToken': 'st.test'}
+    with open('tests/moors.json', 'rb') as src:
+        mapbox.Uploader(access_token=access_token).stage(src, creds=creds)
+    assert MockSession.last.Config is None
+
+
+@responses.activate
+def test_stage_reuse_credentials(monkeypatch):
+    """Credentials and the S3 client are reused, keys are not"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+    MockSession.instances = 0
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+
+    service = mapbox.Uploader(access_token=access_token,
+                              reuse_credentials=True)
+    urls = []
+    keys = []
+    for _ in range(3):
+        with open('tests/moors.json', 'rb') as src:
+            urls.append(service.stage(src))
+        keys.append(MockSession.last.key)
+
+    assert len(responses.calls) == 1
+    assert MockSession.instances == 1
+    assert len(set(urls)) == 3
+    prefix = 'https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{0}/'.format(username)
+    for url, key in zip(urls, keys):
+        assert url.startswith(prefix)
+        assert url.endswith(key)
+        assert key.startswith('_pending/{0}/'.format(username))
+
+    # expired credentials are renewed
+    service._creds_expire = 0
+    with open('tests/moors.json', 'rb') as src:
+        service.stage(src)
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_stage_fresh_credentials(monkeypatch):
+    """By default credentials are requested for every file"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+
+    service = mapbox.Uploader(access_token=access_token)
+    for _ in range(2):
+        with open('tests/moors.json', 'rb') as src:
+            url = service.stage(src)
+        assert url.endswith('_pending/{0}/key.test'.format(username))
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_upload_many(monkeypatch):
+    """Many files are uploaded and polled until complete"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+
+    def create(request):
+        payload = json.loads(request.body.decode())
+        if payload['tileset'].endswith('.conflict'):
+            return (409, {}, '{"message": "conflict"}')
+        upload = json.loads(upload_response_body)
+        upload.update(id=payload['tileset'], tileset=payload['tileset'])
+        return (201, {}, json.dumps(upload))
+
+    responses.add_callback(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}'.format(username),
+        callback=create)
+
+    polls = {}
+
+    def status(request):
+        upload_id = request.path_url.split('?')[0].rsplit('/', 1)[1]
+        polls[upload_id] = polls.get(upload_id, 0) + 1
+        upload = json.loads(upload_response_body)
+        upload.update(id=upload_id, tileset=upload_id)
+        if upload_id.endswith('.broken'):
+            upload['error'] = 'invalid data'
+        elif polls[upload_id] < 3:
+            upload['progress'] = 0.5
+        else:
+            upload.update(progress=1, complete=True)
+        return (200, {}, json.dumps(upload))
+
+    responses.add_callback(
+        responses.GET,
+        re.compile(r'https://api\.mapbox\.com/uploads/v1/{0}/.+'.format(username)),
+        callback=status)
+
+    service = mapbox.Uploader(access_token=access_token)
+    events = list(service.upload_many(
+        [('tests/moors.json', 'one'), ('tests/moors.json', 'two', 'Two'),
+         ('tests/moors.json', 'broken'), ('tests/moors.json', 'conflict')],
+        poll_interval=0.01, rate_limit=1000))
+
+    by_tileset = {}
+    for event in events:
+        by_tileset.setdefault(event['tileset'], []).append(event['type'])
+    assert by_tileset['one'] == ['created', 'progress', 'complete']
+    assert by_tileset['two'] == ['created', 'progress', 'complete']
+    assert by_tileset['broken'] == ['created', 'error']
+    assert by_tileset['conflict'] == ['error']
+    # the unchanged second poll is not reported
+    assert polls['testuser.one'] == 3
+
+
+def test_feature_stream():
+    """Features and NDJSON lines are serialized as a FeatureCollection"""
+    point = {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'Point', 'coordinates': [0, 0]}}
+    lines = [json.dumps(point) + '\n', '\n', json.dumps(point).encode('utf-8')]
+    stream = FeatureStream(iter([point] + lines))
+    data = json.loads(stream.read().decode('utf-8'))
+    assert data['type'] == 'FeatureCollection'
+    assert data['features'] == [point] * 3
+
+
+def test_feature_stream_mappings():
+    """Feature and FeatureCollection mappings are unwrapped"""
+    point = {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'Point', 'coordinates': [0, 0]}}
+    collection = {'type': 'FeatureCollection', 'features': [point, point]}
+    data = json.loads(FeatureStream(collection).read().decode('utf-8'))
+    assert data == collection
+    data = json.loads(FeatureStream(point).read().decode('utf-8'))
+    assert data['features'] == [point]
+    with pytest.raises(mapbox.errors.ValidationError):
+        FeatureStream({'type': 'Point', 'coordinates': [0, 0]})
+
+
+def test_feature_stream_empty():
+    data = json.loads(FeatureStream(iter([])).read().decode('utf-8'))
+    assert data == {'type': 'FeatureCollection', 'features': []}
+
+
+def test_feature_stream_gzip():
+    features = ({'type': 'Feature', 'properties': {'i': i},
+                 'geometry': {'type': 'Point', 'coordinates': [i, 0]}}
+                for i in range(10000))
+    stream = FeatureStream(features, compress=True)
+    chunks = []
+    chunk = stream.read(1000)
+    while chunk:
+        assert len(chunk) <= 1000
+        chunks.append(chunk)
+        chunk = stream.read(1000)
+    data = json.loads(gzip.decompress(b''.join(chunks)).decode('utf-8'))
+    assert len(data['features']) == 10000
+    assert data['features'][-1]['properties']['i'] == 9999
+
+
+def test_feature_stream_full_reads():
+    """Reads are filled, so that s3transfer can detect multipart uploads"""
+    size = 8 * 1024 * 1024
+    features = ({'type': 'Feature', 'properties': {'name': 'x' * 1000},
+                 'geometry': {'type': 'Point', 'coordinates': [i, 0]}}
+                for i in range(10000))
+    stream = FeatureStream(features)
+    assert len(stream.read(size)) == size
+    rest = stream.read(size)
+    assert 0 < len(rest) < size
+    assert stream.read(size) == b''
+
+    reader = mapbox.services.uploads._HashingReader(
+        FeatureStream(iter([{'type': 'Feature', 'properties': {},
+                             'geometry': None}] * 100)))
+    assert len(reader.read(1000)) == 1000
+
+
+def test_stage_features(monkeypatch):
+    """A generator of features is staged without a file"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    creds = {
+        'key': '_pending/{0}/key.test'.format(username),
+        'accessKeyId': 'ak.test',
+        'bucket': 'tilestream-tilesets-production',
+        'url': 'https://example.com/key.test',
+        'secretAccessKey': 'sak.test',
+        'sessionToken': 'st.test'}
+    features = ({'type': 'Feature', 'properties': {'i': i},
+                 'geometry': {'type': 'Point', 'coordinates': [i, 0]}}
+                for i in range(5000))
+    url = mapbox.Uploader(access_token=access_token).stage(
+        features, creds=creds)
+    assert url == 'https://example.com/key.test'
+    data = json.loads(MockSession.last.received.decode('utf-8'))
+    assert len(data['features']) == 5000
+
+
+def test_file_digest():
+    with open('tests/moors.json', 'rb') as src:
+        data = src.read()
+        src.seek(10)
+        assert file_digest(src, blocksize=100) == \
+            hashlib.sha256(data[10:]).hexdigest()
+        assert src.tell() == 10
+
+
+def test_upload_manifest(tmpdir):
+    path = str(tmpdir.join('manifest.json'))
+    manifest = UploadManifest(path)
+    assert manifest.digest('testuser.test1') is None
+    manifest.record('testuser.test1', 'abc', 'id.test')
+    assert 'testuser.test1' in manifest
+    reloaded = UploadManifest(path)
+    assert reloaded.digest('testuser.test1') == 'abc'
+    assert len(reloaded) == 1
+
+
+@responses.activate
+def test_upload_unchanged_skipped(tmpdir, monkeypatch):
+    """Unchanged sources are uploaded once"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}?access_token={1}'.format(username, access_token),
+        match_querystring=True,
+        body=upload_response_body, status=201,
+        content_type='application/json')
+
+    manifest = UploadManifest(str(tmpdir.join('manifest.json')))
+    service = mapbox.Uploader(access_token=access_token)
+
+    res = service.upload('tests/moors.json', 'test1', manifest=manifest)
+    assert res.status_code == 201
+    # nothing is recorded until the upload is complete
+    assert manifest.digest('testuser.test1') is None
+    with open('tests/moors.json', 'rb') as src:
+        assert res.sha256 == file_digest(src)
+    manifest.record('testuser.test1', res.sha256, res.json()['id'])
+    assert len(responses.calls) == 2
+
+    with open('tests/moors.json', 'rb') as src:
+        assert service.upload(src, 'test1', manifest=manifest) is None
+    assert len(responses.calls) == 2
+
+    # a changed source is uploaded
+    changed = tmpdir.join('moors.json')
+    changed.write_binary(b'{}')
+    res = service.upload(str(changed), 'test1', manifest=manifest)
+    assert res.status_code == 201
+    assert len(responses.calls) == 4
+
+
+@responses.activate
+def test_upload_unchanged_features_not_created(tmpdir, monkeypatch):
+    """Streamed sources are hashed while staged"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}?access_token={1}'.format(username, access_token),
+        match_querystring=True,
+        body=upload_response_body, status=201,
+        content_type='application/json')
+
+    def features():
+        for i in range(3):
+            yield {'type': 'Feature', 'properties': {},
+                   'geometry': {'type': 'Point', 'coordinates': [i, 0]}}
+
+    manifest = UploadManifest(str(tmpdir.join('manifest.json')))
+    service = mapbox.Uploader(access_token=access_token)
+    res = service.upload(features(), 'test1', manifest=manifest)
+    assert res.status_code == 201
+    manifest.record('testuser.test1', res.sha256)
+    assert service.upload(features(), 'test1', manifest=manifest) is None
+    # staged twice, created once
+    assert [c.request.url.split('?')[0].rsplit('/', 1)[1]
+            for c in responses.calls] == [
+                'credentials', username, 'credentials']
+
+
+@responses.activate
+def test_upload_many_manifest(tmpdir, monkeypatch):
+    """Digests are recorded on completion and forgotten on failure"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+
+    def create(request):
+        payload = json.loads(request.body.decode())
+        upload = json.loads(upload_response_body)
+        upload.update(id=payload['tileset'], tileset=payload['tileset'])
+        return (201, {}, json.dumps(upload))
+
+    responses.add_callback(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}'.format(username),
+        callback=create)
+
+    def status(request):
+        upload_id = request.path_url.split('?')[0].rsplit('/', 1)[1]
+        upload = json.loads(upload_response_body)
+        upload.update(id=upload_id, tileset=upload_id)
+        if upload_id.endswith('.broken'):
+            upload['error'] = 'invalid data'
+        else:
+            upload.update(progress=1, complete=True)
+        return (200, {}, json.dumps(upload))
+
+    responses.add_callback(
+        responses.GET,
+        re.compile(r'https://api\.mapbox\.com/uploads/v1/{0}/.+'.format(username)),
+        callback=status)
+
+    manifest = UploadManifest(str(tmpdir.join('manifest.json')))
+    manifest.record('testuser.broken', 'stale')
+    service = mapbox.Uploader(access_token=access_token)
+    jobs = [('tests/moors.json', 'good'), ('tests/moors.json', 'broken')]
+    list(service.upload_many(jobs, poll_interval=0.01, rate_limit=1000,
+                             manifest=manifest))
+
+    with open('tests/moors.json', 'rb') as src:
+        assert manifest.digest('testuser.good') == file_digest(src)
+    assert 'testuser.broken' not in manifest
+
+    events = list(service.upload_many(
+        jobs, poll_interval=0.01, rate_limit=1000, manifest=manifest))
+    assert [(e['type'], e['tileset']) for e in events
+            if e['type'] in ('skipped', 'complete')] == [('skipped', 'good')]
+
+
+def test_stage_bytes_filename(monkeypatch):
+    """A bytes filename is opened, not serialized"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    creds = {
+        'key': '_pending/{0}/key.test'.format(username),
+        'accessKeyId': 'ak.test',
+        'bucket': 'tilestream-tilesets-production',
+        'url': 'https://example.com/key.test',
+        'secretAccessKey': 'sak.test',
+        'sessionToken': 'st.test'}
+    mapbox.Uploader(access_token=access_token).stage(
+        b'tests/moors.json', creds=creds)
+    with open('tests/moors.json', 'rb') as src:
+        assert MockSession.last.received == src.read()
+
+
+@responses.activate
+def test_upload_many_poll_connection_error(monkeypatch):
+    """A failed status request is retried"""
+
+    monkeypatch.setattr(mapbox.services.uploads, 'boto3_session', MockSession)
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}?access_token={1}'.format(username, access_token),
+        match_querystring=True,
+        body=upload_response_body, status=201,
+        content_type='application/json')
+
+    polls = []
+
+    def status(request):
+        polls.append(request.url)
+        if len(polls) == 1:
+            raise requests.exceptions.ConnectionError('connection reset')
+        upload = json.loads(upload_response_body)
+        upload.update(progress=1, complete=True)
+        return (200, {}, json.dumps(upload))
+
+    responses.add_callback(
+        responses.GET,
+        re.compile(r'https://api\.mapbox\.com/uploads/v1/{0}/.+'.format(username)),
+        callback=status)
+
+    service = mapbox.Uploader(access_token=access_token)
+    events = list(service.upload_many(
+        [('tests/moors.json', 'test1')], poll_interval=0.01, rate_limit=1000))
+    assert [e['type'] for e in events] == ['created', 'complete']
+    assert len(polls) == 2
+
+
+class StrictMockSession(MockSession):
+    """Mocks credentials that only allow writes to their own key."""
+
+    def upload_fileobj(self, data, bucket, key, Callback=None, Config=None):
+        if key != '_pending/{0}/key.test'.format(username):
+            raise S3UploadFailedError(
+                'An error occurred (AccessDenied) when calling the '
+                'PutObject operation: Access Denied')
+        super(StrictMockSession, self).upload_fileobj(
+            data, bucket, key, Callback=Callback, Config=Config)
+
+
+@responses.activate
+def test_stage_reuse_credentials_access_denied(monkeypatch):
+    """Reuse stops if credentials are scoped to their key"""
+
+    monkeypatch.setattr(
+        mapbox.services.uploads, 'boto3_session', StrictMockSession)
+
+    query_body = """
+       {{"key": "_pending/{username}/key.test",
+         "accessKeyId": "ak.test",
+         "bucket": "tilestream-tilesets-production",
+         "url": "https://tilestream-tilesets-production.s3.amazonaws.com/_pending/{username}/key.test",
+         "secretAccessKey": "sak.test",
+         "sessionToken": "st.test"}}""".format(username=username)
+    responses.add(
+        responses.POST,
+        'https://api.mapbox.com/uploads/v1/{0}/credentials?access_token={1}'.format(
+            username, access_token),
+        match_querystring=True,
+        body=query_body, status=200,
+        content_type='application/json')
+
+    service = mapbox.Uploader(access_token=access_token,
+                              reuse_credentials=True)
+    for _ in range(3):
+        with open('tests/moors.json', 'rb') as src:
+            url = service.stage(src)
+        assert url.endswith('_pending/{0}/key.test'.format(username))
+    with open('tests/moors.json', 'rb') as src:
+        assert MockSession.last.received == src.read()
+    # the second file was denied and staged with fresh credentials
+    assert not service.reuse_credentials
+    assert len(responses.calls) == 3
+
+    # a stream cannot be staged again
+    service.reuse_credentials = True
+    service.stage(iter([]))
+    with pytest.raises(S3UploadFailedError):
+        service.stage(iter([]))
+
+
+def test_credentials_expiry():
+    """Credentials are renewed shortly before they expire"""
+    creds = {'expiration': '2030-01-01T00:00:00Z'}
+    service = mapbox.Uploader(access_token=access_token,
+                              reuse_credentials=True)
+    service.credentials_ttl = 10 ** 10
+    assert service._credentials_expiry(creds) == 1893456000 - 300
+    creds['expiration'] = time.time() + 60
+    assert service._credentials_expiry(creds) < time.time()
+    service.credentials_ttl = 1800
+    assert service._credentials_expiry({}) > time.time() + 1700
@@ -1,6 +1,6 @@
 import pytest
 
-from mapbox.utils import normalize_geojson_featurecollection
+from mapbox.utils import haversine, normalize_geojson_featurecollection
 
 
 geom = {'type': 'Point', 'coordinates': (-122, 45)}
@@ -64,3 +64,9 @@ def test_nonsense():
 
     with pytest.raises(ValueError):
         normalize_geojson_featurecollection({'type': 'not-geojson'})
+
+
+def test_haversine():
+    assert haversine(0, 0, 0, 0) == 0
+    assert haversine(0, 0, 1, 0) == pytest.approx(111195, rel=1e-4)
+    assert haversine(-180, 0, 180, 0) == pytest.approx(0, abs=1e-6)